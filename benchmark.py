@@ -0,0 +1,282 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from connections_graph import ConnectionsGraph, RidesGraph
+from main import evaluate_paths
+from network import TRANSFER_MINUTES
+from path_calculations import ConnectionsAccess, PathCalculations, TransferPathCalculations, calculate_all_origins, get_path
+from pid_gtfs import PidGtfs
+from spatial_index import SpatialIndex, haversine_many
+from transfer_count import update_path_with_transfer_count
+
+
+# Synthetic network area (around the Prague center) and vehicle speed
+CENTER_GPS = (50.0755, 14.4378)
+AREA_KM = 20.0
+SPEED_KMH = 25.0
+DWELL_SECONDS = 20
+
+STOPS_HEADER = "stop_id,stop_name,stop_lat,stop_lon,zone_id,stop_url,location_type,parent_station,wheelchair_boarding,level_id,platform_code\n"
+STOP_TIMES_HEADER = "trip_id,arrival_time,departure_time,stop_id,stop_sequence,stop_headsign,pickup_type,drop_off_type,shape_dist_traveled\n"
+TRANSFERS_HEADER = "from_stop_id,to_stop_id,transfer_type,min_transfer_time,from_trip_id,to_trip_id\n"
+PATHWAYS_HEADER = "pathway_id,from_stop_id,to_stop_id,pathway_mode,is_bidirectional,traversal_time,Shape_Length\n"
+
+CALCULATION_PARAMETERS = {"start_hour": 16, "stop_hour": 18, "trip_frequency_min": 6, "footpath_radius_m": 250}
+START_STOP_COUNT = 4
+REGRESSION_RATIO = 1.2
+
+
+def generate_feed(directory: str, station_count: int = 1000, line_count: int = 60, line_stops: tuple = (10, 30),
+                  headway_min: tuple = (5, 20), start_hour: int = 4, stop_hour: int = 24, seed: int = 1) -> dict:
+    """
+    Write a synthetic GTFS feed (stops, stop_times, transfers and pathways) to the directory.
+    The stations are spread over the area with 1-3 platforms (stop IDs with the same name),
+    each line is a walk through neighbouring stations, driven in both directions
+    every headway minutes from start_hour to stop_hour. Every fourth trip turns back early,
+    so there are sub-trips too. The same parameters and seed give the same files.
+    Returns the counts of the written rows.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    km_per_lat = math.radians(1) * 6372.8
+    km_per_lon = km_per_lat * math.cos(math.radians(CENTER_GPS[0]))
+
+    stations = []  # [(name, latitude, longitude, [stop IDs])]
+    with open(os.path.join(directory, "stops.txt"), "w", encoding="utf8") as f:
+        f.write(STOPS_HEADER)
+        for station in range(station_count):
+            latitude = CENTER_GPS[0] + rng.uniform(-AREA_KM, AREA_KM) / 2 / km_per_lat
+            longitude = CENTER_GPS[1] + rng.uniform(-AREA_KM, AREA_KM) / 2 / km_per_lon
+            name = f"Stop {station}"
+            stop_ids = []
+            for platform in range(rng.randint(1, 3)):
+                stop_id = f"S{station}Z{platform + 1}P"
+                stop_ids.append(stop_id)
+                f.write(f'{stop_id},"{name}",{latitude + rng.uniform(-3e-4, 3e-4):.5f},{longitude + rng.uniform(-3e-4, 3e-4):.5f},'
+                        f'"P",,0,,1,,{platform + 1}\n')
+            stations.append((name, latitude, longitude, stop_ids))
+
+    index = SpatialIndex([station[1] for station in stations], [station[2] for station in stations])
+
+    row_count = 0
+    trip_count = 0
+    with open(os.path.join(directory, "stop_times.txt"), "w", encoding="utf8") as f:
+        f.write(STOP_TIMES_HEADER)
+        for line in range(line_count):
+            # Walk to one of the closest not visited stations
+            route = [rng.randrange(station_count)]
+            for _ in range(rng.randint(*line_stops) - 1):
+                (_, latitude, longitude, _) = stations[route[-1]]
+                neighbours = [station for (station, _) in index.nearest((latitude, longitude), 8) if station not in route]
+                if not neighbours:
+                    break
+                route.append(rng.choice(neighbours))
+
+            headway = rng.randint(*headway_min)
+            for direction in (0, 1):
+                stop_ids = [rng.choice(stations[station][3]) for station in (route if direction == 0 else route[::-1])]
+                hops_km = [haversine_many(stations[station_from][1:3], [stations[station_to][1]], [stations[station_to][2]])[0] / 1000 * 1.3
+                           for (station_from, station_to) in zip(route, route[1:])]
+                if direction == 1:
+                    hops_km.reverse()
+
+                for (number, departure) in enumerate(range(start_hour * 60, stop_hour * 60, headway)):
+                    trip_id = f"{line}_{direction}_{number}"
+                    length = len(stop_ids) if number % 4 != 3 else max(2, len(stop_ids) * 2 // 3)
+                    seconds = departure * 60 + rng.randint(0, 59)
+                    traveled = 0.0
+                    for position in range(length):
+                        time_text = f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+                        f.write(f"{trip_id},{time_text},{time_text},{stop_ids[position]},{position + 1},,0,0,{traveled:.5f}\n")
+                        if position < length - 1:
+                            traveled += hops_km[position]
+                            seconds += round(hops_km[position] / SPEED_KMH * 3600 * rng.uniform(0.9, 1.2)) + DWELL_SECONDS
+                    row_count += length
+                    trip_count += 1
+
+    # Transfers and pathways between the platforms of some close stations
+    transfer_count = 0
+    pathway_count = 0
+    with open(os.path.join(directory, "transfers.txt"), "w", encoding="utf8") as transfers, \
+            open(os.path.join(directory, "pathways.txt"), "w", encoding="utf8") as pathways:
+        transfers.write(TRANSFERS_HEADER)
+        pathways.write(PATHWAYS_HEADER)
+        for (station, (_, latitude, longitude, stop_ids)) in enumerate(stations):
+            if rng.random() >= 0.1:
+                continue
+            (neighbour, meters) = index.nearest((latitude, longitude), 2)[-1]
+            if rng.random() < 0.5:
+                minutes = round(meters / 1000 / 4.5 * 60 * 60) + 60
+                transfers.write(f"{stop_ids[0]},{stations[neighbour][3][0]},2,{minutes},,\n")
+                transfer_count += 1
+            else:
+                pathways.write(f"P{station},{stop_ids[0]},{stations[neighbour][3][0]},1,1,,{meters * 1.2:.1f}\n")
+                pathway_count += 1
+
+    return {"stations": station_count, "stop_ids": sum(len(station[3]) for station in stations), "trips": trip_count,
+            "stop_times": row_count, "transfers": transfer_count, "pathways": pathway_count,
+            "stop_times_bytes": os.path.getsize(os.path.join(directory, "stop_times.txt"))}
+
+
+def measure(name: str, function, setup=None, repeat: int = 3) -> dict:
+    """
+    Time the function repeat times, each time with fresh arguments from setup (not timed),
+    then run it once more under tracemalloc for the peak of the allocated memory.
+    """
+    times = []
+    for _ in range(repeat):
+        arguments = setup() if setup is not None else ()
+        start = time.perf_counter()
+        function(*arguments)
+        times.append(time.perf_counter() - start)
+
+    arguments = setup() if setup is not None else ()
+    tracemalloc.start()
+    try:
+        function(*arguments)
+        (_, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    print(f"    - {name}: {min(times) * 1000:.1f} ms (mean {sum(times) / len(times) * 1000:.1f} ms), peak {peak / 1024:.0f} KiB")
+    return {"name": name, "repeat": repeat, "min_s": min(times), "mean_s": sum(times) / len(times), "peak_memory_bytes": peak}
+
+
+def run_benchmarks(directory: str, repeat: int = 3) -> list:
+    """
+    Benchmarks of the network calculation phases and the path searches over the feed in the directory.
+    Each phase gets the inputs prepared by the phases before it.
+    """
+    stops_file = os.path.join(directory, "stops.txt")
+    stop_times_file = os.path.join(directory, "stop_times.txt")
+    transfers_file = os.path.join(directory, "transfers.txt")
+    pathways_file = os.path.join(directory, "pathways.txt")
+    (start_hour, stop_hour) = (CALCULATION_PARAMETERS["start_hour"], CALCULATION_PARAMETERS["stop_hour"])
+    trip_frequency_min = CALCULATION_PARAMETERS["trip_frequency_min"]
+
+    pid_gtfs = PidGtfs()
+    results = []
+
+    def processed_trips() -> dict:
+        return pid_gtfs._process_trips(pid_gtfs._parse_trips(stop_times_file, start_hour, stop_hour), trip_frequency_min)
+
+    results.append(measure("_parse_trips", pid_gtfs._parse_trips, lambda: (stop_times_file, start_hour, stop_hour), repeat))
+    results.append(measure("_process_trips", pid_gtfs._process_trips,
+                           lambda: (pid_gtfs._parse_trips(stop_times_file, start_hour, stop_hour), trip_frequency_min), repeat))
+
+    trips = processed_trips()
+    results.append(measure("_fill_stop_ids", pid_gtfs._fill_stop_ids, lambda: (pid_gtfs._parse_stop_ids(stops_file), trips), repeat))
+
+    stop_ids = pid_gtfs._parse_stop_ids(stops_file)
+    for trip in trips.values():
+        for trip_stop in trip.trip_stops:
+            trip_stop.name_to = stop_ids[trip_stop.stop_id_to].name
+            trip_stop.name_from = stop_ids[trip_stop.stop_id_from].name
+    pid_gtfs._fill_stop_ids(stop_ids, trips)
+    stops = pid_gtfs._prepare_stops(stop_ids)
+    pid_gtfs._add_footpaths(stops, stop_ids, CALCULATION_PARAMETERS["footpath_radius_m"], transfers_file, pathways_file)
+    results.append(measure("_to_result_json", pid_gtfs._to_result_json, lambda: (stops, trips), repeat))
+
+    buckets_gtfs = PidGtfs()
+    buckets_gtfs.calculate_buckets(stops_file, stop_times_file, CALCULATION_PARAMETERS["footpath_radius_m"], transfers_file, pathways_file)
+    results.append(measure("compose", buckets_gtfs.compose, lambda: (start_hour, stop_hour, trip_frequency_min), repeat))
+
+    graph = ConnectionsGraph.from_json(pid_gtfs.get_results())
+    connections = ConnectionsAccess.from_graph(graph)
+    rides = RidesGraph(graph, pid_gtfs.get_trips())
+    # The best connected stops, so the searches cover the network
+    start_stops = sorted(connections.get_stops(), key=lambda stop: (-len(graph.get_connections(graph.get_id(stop))), stop))[:START_STOP_COUNT]
+
+    results.append(measure("PathCalculations.find_all_connections",
+                           lambda calculation: calculation.find_all_connections(),
+                           lambda: (PathCalculations(connections, start_stops[0]),), repeat))
+    results.append(measure("TransferPathCalculations.find_all_connections",
+                           lambda calculation: calculation.find_all_connections(),
+                           lambda: (TransferPathCalculations(connections, start_stops[0], rides, TRANSFER_MINUTES),), repeat))
+
+    travel_times = calculate_all_origins(connections, start_stops, processes=1)
+    footpaths = {(stop, target) for stop in connections.get_stops() for target in connections.get_footpaths(stop)}
+
+    def all_paths() -> tuple:
+        paths = []
+        for results_list in travel_times.results:
+            results_by_stop = {result[0]: result for result in results_list}
+            paths.append({stop: {"distance_min": result[1], "path": get_path(results_by_stop, stop), "transfers": 0}
+                          for (stop, result) in results_by_stop.items()})
+        return (paths, pid_gtfs.get_trips(), footpaths)
+
+    results.append(measure("update_path_with_transfer_count", update_path_with_transfer_count, all_paths, repeat))
+
+    travel_times = calculate_all_origins(connections, start_stops, rides, TRANSFER_MINUTES, processes=1)
+    results.append(measure("evaluate_paths", evaluate_paths, lambda: (travel_times, TRANSFER_MINUTES), repeat))
+
+    return results
+
+
+def compare(results: list, baseline: list, ratio: float = REGRESSION_RATIO) -> list:
+    """
+    Names of the benchmarks slower (minimum time) or using more memory than ratio x the baseline.
+    """
+    baseline_by_name = {result["name"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline_by_name.get(result["name"])
+        if old is None:
+            continue
+
+        time_ratio = result["min_s"] / old["min_s"] if old["min_s"] > 0 else 1.0
+        memory_ratio = result["peak_memory_bytes"] / old["peak_memory_bytes"] if old["peak_memory_bytes"] > 0 else 1.0
+        regressed = time_ratio > ratio or memory_ratio > ratio
+        print(f"    - {result['name']}: time x{time_ratio:.2f}, memory x{memory_ratio:.2f}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(result["name"])
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the network calculation and path searches on a synthetic GTFS feed")
+    parser.add_argument("--stations", type=int, default=1000, help="Number of stations (1-3 stop IDs each)")
+    parser.add_argument("--lines", type=int, default=60, help="Number of lines, driven in both directions")
+    parser.add_argument("--headway", type=int, nargs=2, default=(5, 20), metavar=("MIN", "MAX"), help="Minutes between the trips of a line")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--feed", help="Directory for the generated feed, a temporary one without it")
+    parser.add_argument("--output", help="JSON file for the results, printed without it")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = arguments.feed or temporary_directory
+        print(f"Generating synthetic GTFS feed to {directory}")
+        feed = generate_feed(directory, arguments.stations, arguments.lines, headway_min=tuple(arguments.headway), seed=arguments.seed)
+        print(f"    - {feed['stop_ids']} stop IDs, {feed['trips']} trips, {feed['stop_times']} stop times")
+
+        print("Running benchmarks")
+        results = run_benchmarks(directory, arguments.repeat)
+
+    report = {"python": platform.python_version(), "feed": feed, "parameters": CALCULATION_PARAMETERS, "benchmarks": results}
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if arguments.baseline:
+        print(f"Comparing with {arguments.baseline}")
+        with open(arguments.baseline, encoding="utf8") as f:
+            regressions = compare(results, json.load(f)["benchmarks"])
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
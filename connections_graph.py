@@ -0,0 +1,159 @@
+from array import array
+import math
+
+
+class ConnectionsGraph():
+    """
+    Compiled form of the JSON connection data for the path engines.
+    Stop names are interned to integer IDs and the connections are stored
+    as CSR (compressed sparse row) arrays: connections of stop `i` are
+    `targets[offsets[i]:offsets[i + 1]]` with the matching distances.
+    Walking flags mark the footpath edges, the others are ridden by vehicles.
+    """
+
+    def __init__(self, names: list, latitudes: array, longitudes: array, offsets: array, targets: array,
+                 distances_min: array, distances_km: array, walking: bytearray = None):
+        self.names = names
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.offsets = offsets
+        self.targets = targets
+        self.distances_min = distances_min
+        self.distances_km = distances_km
+        self.walking = walking if walking is not None else bytearray(len(targets))
+        self._ids = {name: index for (index, name) in enumerate(names)}
+
+    @classmethod
+    def from_json(cls, json_data: dict):
+        """
+        Build the graph from the connections JSON (see PidGtfs.get_results).
+        Stops only reachable as a connection target get IDs after all
+        the stops with connections, with unknown (NaN) GPS.
+        Footpaths follow the connections of each stop, with the walking flag.
+        """
+        names = list(json_data.keys())
+        ids = {name: index for (index, name) in enumerate(names)}
+        for stop in json_data.values():
+            for connection in list(stop["connections"]) + list(stop.get("footpaths", {})):
+                if connection not in ids:
+                    ids[connection] = len(names)
+                    names.append(connection)
+
+        latitudes = array("d", [math.nan]) * len(names)
+        longitudes = array("d", [math.nan]) * len(names)
+        offsets = array("l", [0])
+        targets = array("l")
+        distances_min = array("d")
+        distances_km = array("d")
+        walking = bytearray()
+
+        for (index, name) in enumerate(names):
+            stop = json_data.get(name)
+            if stop is not None:
+                latitudes[index] = stop["latitude"]
+                longitudes[index] = stop["longitude"]
+                for (kind, key) in enumerate(("connections", "footpaths")):
+                    for (connection, distance) in stop.get(key, {}).items():
+                        targets.append(ids[connection])
+                        distances_min.append(distance["distance_min"])
+                        distances_km.append(distance["distance_km"])
+                        walking.append(kind)
+            offsets.append(len(targets))
+
+        return cls(names, latitudes, longitudes, offsets, targets, distances_min, distances_km, walking)
+
+    def to_json(self) -> dict:
+        """
+        Inverse of from_json, stops without GPS and connections are left out.
+        """
+        json_data = {}
+        for (index, name) in enumerate(self.names):
+            if math.isnan(self.latitudes[index]):
+                continue
+
+            connections = {}
+            footpaths = {}
+            for edge in self.get_connections(index):
+                distances = footpaths if self.walking[edge] else connections
+                distances[self.names[self.targets[edge]]] = {"distance_km": self.distances_km[edge], "distance_min": self.distances_min[edge]}
+            json_data[name] = {"longitude": self.longitudes[index], "latitude": self.latitudes[index],
+                               "connections": connections, "footpaths": footpaths}
+
+        return json_data
+
+    def get_stop_count(self) -> int:
+        return len(self.names)
+
+    def get_connection_count(self) -> int:
+        return len(self.targets)
+
+    def get_id(self, stop: str) -> int:
+        return self._ids[stop]
+
+    def get_name(self, stop_id: int) -> str:
+        return self.names[stop_id]
+
+    def has_stop(self, stop: str) -> bool:
+        return stop in self._ids
+
+    def get_connections(self, stop_id: int) -> range:
+        """
+        Range of edge indexes into targets and distances for the stop ID.
+        """
+        return range(self.offsets[stop_id], self.offsets[stop_id + 1])
+
+
+class RidesGraph():
+    """
+    Trips compiled over a ConnectionsGraph for the transfer aware path engine.
+    Every trip is a ride, each graph connection not driven by any trip becomes
+    a ride of its own. Positions of all rides are flattened into one array,
+    so a state "on board of a ride at a stop" is a single position index.
+    Footpaths are not rides, they are walked between the stops.
+    """
+
+    def __init__(self, graph: ConnectionsGraph, trips: list):
+        self.graph = graph
+        self.position_stops = array("l")  # Stop ID at each ride position
+        self.position_minutes = array("d")  # Minutes to the next position of the ride, inf at the ride end
+
+        minutes = {}  # (stop ID, stop ID): minutes
+        for stop_id in range(graph.get_stop_count()):
+            for edge in graph.get_connections(stop_id):
+                if not graph.walking[edge]:
+                    minutes[(stop_id, graph.targets[edge])] = graph.distances_min[edge]
+
+        driven = set()
+        for trip in trips:
+            if not all(graph.has_stop(stop) for stop in trip):
+                continue  # Trip outside the graph
+
+            ride = [graph.get_id(stop) for stop in trip]
+            driven.update(zip(ride, ride[1:]))
+            self._add_ride(ride, minutes)
+
+        for connection in minutes:
+            if connection not in driven:
+                self._add_ride(list(connection), minutes)
+
+        # Boarding positions of each stop in CSR form (positions at a ride end are left out)
+        boardings = [[] for _ in range(graph.get_stop_count())]
+        for (position, stop_id) in enumerate(self.position_stops):
+            if self.position_minutes[position] != math.inf:
+                boardings[stop_id].append(position)
+
+        self.boarding_offsets = array("l", [0])
+        self.boarding_positions = array("l")
+        for positions in boardings:
+            self.boarding_positions.extend(positions)
+            self.boarding_offsets.append(len(self.boarding_positions))
+
+    def get_position_count(self) -> int:
+        return len(self.position_stops)
+
+    def _add_ride(self, ride: list, minutes: dict):
+        for (stop_id, next_stop_id) in zip(ride, ride[1:]):
+            self.position_stops.append(stop_id)
+            self.position_minutes.append(minutes.get((stop_id, next_stop_id), math.inf))
+        self.position_stops.append(ride[-1])
+        self.position_minutes.append(math.inf)
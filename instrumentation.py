@@ -0,0 +1,133 @@
+import cProfile
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+import json
+import pstats
+import time
+import tracemalloc
+
+
+@dataclass
+class Phase:
+    """
+    One measured phase of a run. Nested phases have the name of the enclosing phase as parent.
+    Memory is only measured with track_memory, the peak is the highest traced memory while the phase ran.
+    """
+    name: str
+    parent: str = None
+    wall_s: float = 0.0
+    peak_memory_bytes: int = None
+    memory_delta_bytes: int = None
+    counters: dict = field(default_factory=dict)
+    summary: str = ""
+
+    def count(self, counter: str, value: int = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+
+class Instrumentation():
+    """
+    Per-phase wall time, peak memory and counters of a run (network calculation, path searches, ...).
+    Each phase prints its description when it starts and its summary with the time when it is done,
+    finished phases are passed to the callback and kept for the JSON report.
+    Counters are added to the innermost running phase, so they can be counted deep in the code.
+    With profile the whole run (from the first phase start) is profiled by cProfile.
+    """
+
+    def __init__(self, track_memory: bool = False, profile: bool = False, callback=None):
+        self._track_memory = track_memory
+        self._callback = callback
+        self._profiler = cProfile.Profile() if profile else None
+        self._running = []  # Stack of (Phase, start time, start memory)
+        self._phases = []  # Finished phases
+        self._counters = {}  # Counters outside of any phase
+
+    @contextmanager
+    def phase(self, name: str, description: str = None):
+        """
+        Measure the code in the with block as the named phase, yields the Phase for counters and summary.
+        """
+        if description is not None:
+            print(description)
+
+        if not self._running:
+            if self._track_memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self._profiler is not None:
+                self._profiler.enable()
+        current = Phase(name=name, parent=self._running[-1][0].name if self._running else None)
+        self._update_peaks()
+        self._running.append((current, time.perf_counter(), self._get_memory()))
+        try:
+            yield current
+        finally:
+            self._update_peaks()
+            (_, start, start_memory) = self._running.pop()
+            current.wall_s = time.perf_counter() - start
+            if start_memory is not None:
+                current.memory_delta_bytes = self._get_memory() - start_memory
+            if not self._running and self._profiler is not None:
+                self._profiler.disable()
+
+            self._phases.append(current)
+            if description is not None:
+                print(f"    - {current.summary + ', ' if current.summary else ''}done in {current.wall_s:.2f} s")
+            if self._callback is not None:
+                self._callback(asdict(current))
+
+    def count(self, counter: str, value: int = 1):
+        """
+        Add to the counter of the innermost running phase.
+        """
+        if self._running:
+            self._running[-1][0].count(counter, value)
+        else:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def get_phases(self) -> list:
+        return list(self._phases)
+
+    def get_profile(self, top: int = 30) -> list:
+        """
+        The top functions by cumulative time, empty without profile.
+        """
+        if self._profiler is None:
+            return []
+
+        stats = pstats.Stats(self._profiler)
+        functions = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:top]
+        return [{"function": f"{file}:{line}({function})", "calls": calls, "total_s": total, "cumulative_s": cumulative}
+                for ((file, line, function), (_, calls, total, cumulative, _)) in functions]
+
+    def dump_profile(self, profile_file: str):
+        """
+        Save the cProfile statistics for pstats or other viewers.
+        """
+        if self._profiler is not None:
+            self._profiler.dump_stats(profile_file)
+
+    def to_json(self) -> dict:
+        return {"phases": [asdict(phase) for phase in self._phases], "counters": dict(self._counters), "profile": self.get_profile()}
+
+    def save(self, metrics_json: str):
+        with open(metrics_json, "w", encoding="utf8") as f:
+            json.dump(self.to_json(), f, ensure_ascii=False, indent=4)
+
+    def _get_memory(self):
+        if not self._track_memory:
+            return None
+
+        return tracemalloc.get_traced_memory()[0]
+
+    def _update_peaks(self):
+        """
+        Fold the peak since the last reset into all running phases and start a new peak interval,
+        so nested phases get their own peak and the enclosing ones still see it.
+        """
+        if not self._track_memory:
+            return
+
+        peak = tracemalloc.get_traced_memory()[1]
+        for (phase, _, _) in self._running:
+            phase.peak_memory_bytes = max(phase.peak_memory_bytes or 0, peak)
+        tracemalloc.reset_peak()
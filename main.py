@@ -1,124 +1,170 @@
-from pid_gtfs import PidGtfs
-from path_calculations import ConnectionsAccess, PathCalculations
-from transfer_count import update_path_with_transfer_count
+import argparse
+
+from connections_graph import RidesGraph
+from instrumentation import Instrumentation
+from network import (CALCULATION_PARAMETERS, PATH_CACHE_DIRECTORY, TIME_WINDOWS, TRANSFER_MINUTES, TRAVEL_MATRIX_FILE,
+                     has_gtfs_feed, load_or_calculate_network)
+from point_to_point import PointToPointSearch
+from meeting_point import MeetingPointSearch, score_matrix, top_k
+from path_cache import PathCache
+from path_calculations import ConnectionsAccess, TravelTimes, calculate_all_origins, get_path
+from travel_matrix import TravelMatrix
 
 
-RESULT_STOPS_JSON_FILE = "output/connections.json"
-RESULT_TRIPS_JSON_FILE = "output/trips.json"
 RESULT_TEXT_FILE = "output/results.txt"
+MEETING_POINTS = 21  # Best meeting stops printed and saved with their paths
 
 
 def main():
-    pid_gtfs = PidGtfs()
-
-    print(f"Load last results from {RESULT_STOPS_JSON_FILE} and {RESULT_TRIPS_JSON_FILE}, if possible")
-    try:
-        pid_gtfs.load(RESULT_STOPS_JSON_FILE, RESULT_TRIPS_JSON_FILE)
-    except:
-        print("Error loading last results, must recalculate")
-        pid_gtfs.calculate(16, 18, 6)
-        print(f"Saving results to {RESULT_STOPS_JSON_FILE} and {RESULT_TRIPS_JSON_FILE}")
-        pid_gtfs.save(RESULT_STOPS_JSON_FILE, RESULT_TRIPS_JSON_FILE)
-    else:
-        print("Results loaded")
-
-    results_stops = pid_gtfs.get_results()
-    result_trips = pid_gtfs.get_trips()
-
-    print("Creating class for accessing results")
-    connections = ConnectionsAccess(results_stops)
-
-    print("Calculating all connection paths and times")
-    start_stops = ["Na Pískách", "Kudrnova", "Branické náměstí", "Sídliště Malešice"]
-    all_paths = get_all_paths(connections, start_stops)
-
-    print("Updating with minimum transfers needed")
-    update_path_with_transfer_count(all_paths, result_trips)
-
-    print("Evaluating stops - the lower score the better")
-    stops = connections.get_stops()
-    #scores = evaluate_paths(stops, all_paths, 2, sum)
-    scores = evaluate_paths(stops, all_paths, 2, score_function)
-
-    print("Printing results")
-    for (index, value) in enumerate(scores):
-        print(f"{index + 1}. {value[0]} ({value[1]})")
-
-        for path in all_paths:
-            print(f"\t - {path[value[0]]['transfers']} transfers, path:  {path[value[0]]['path']}")
-
-        if index == 20:
-            break
-
-    print("Saving results to file")
-    with open(RESULT_TEXT_FILE, "w", encoding="utf8") as f:
-        for (index, value) in enumerate(scores):
-            f.write(f"{index + 1}. {value[0]} ({value[1]})\n")
-
-            for path in all_paths:
-                f.write(f"\t - {path[value[0]]['transfers']} transfers, path:  {path[value[0]]['path']}\n")
-
-            f.write("\n")
-
-
-def get_all_paths(connections: ConnectionsAccess, start_stops: list):
+    parser = argparse.ArgumentParser(description="Find the best stops to meet")
+    parser.add_argument("--metrics", help="JSON file for the per-phase time, memory and counters")
+    parser.add_argument("--memory", action="store_true", help="Measure the peak memory of the phases (slower)")
+    parser.add_argument("--profile", help="Profile the run with cProfile and save the statistics to the file")
+    parser.add_argument("--window", choices=TIME_WINDOWS, help="Time window of the network (afternoon by default)")
+    parser.add_argument("--early", action="store_true",
+                        help="Only the best meeting stops by minutes (no transfers), with the early terminating search")
+    arguments = parser.parse_args()
+    parameters = CALCULATION_PARAMETERS
+    if arguments.window is not None:
+        if not has_gtfs_feed():
+            parser.error("--window needs the GTFS feed in gtfs/, the last results are of a fixed time window")
+        parameters = dict(CALCULATION_PARAMETERS, **TIME_WINDOWS[arguments.window])
+
+    instrumentation = Instrumentation(track_memory=arguments.memory, profile=arguments.profile is not None)
+    with instrumentation.phase("main"):
+        with instrumentation.phase("network"):
+            (graph, result_trips, key) = load_or_calculate_network(instrumentation, parameters)
+
+        with instrumentation.phase("connections", "Creating class for accessing results"):
+            connections = ConnectionsAccess.from_graph(graph)
+
+        start_stops = ["Na Pískách", "Kudrnova", "Branické náměstí", "Sídliště Malešice"]
+        if arguments.early:
+            find_early_meeting_points(connections, start_stops, instrumentation)
+        else:
+            with instrumentation.phase("paths", "Calculating all connection paths, times and transfers") as phase:
+                # Start stops precomputed in the travel matrix (see travel_matrix.py) are looked up without searching
+                matrix = TravelMatrix.load(TRAVEL_MATRIX_FILE, key, graph)
+                if (matrix is not None and matrix.transfer_minutes == TRANSFER_MINUTES
+                        and all(matrix.has_origin(start_stop) for start_stop in start_stops)):
+                    travel_times = matrix.get_travel_times(start_stops)
+                    phase.summary = f"looked up in {TRAVEL_MATRIX_FILE}"
+                else:
+                    rides = RidesGraph(graph, result_trips)
+                    cache = PathCache(PATH_CACHE_DIRECTORY, key)
+                    travel_times = calculate_all_origins(connections, start_stops, rides, TRANSFER_MINUTES, cache=cache,
+                                                         instrumentation=instrumentation)
+
+            with instrumentation.phase("evaluate", "Evaluating stops - the lower score the better") as phase:
+                #scores = evaluate_paths(travel_times, TRANSFER_MINUTES, "sum")
+                scores = evaluate_paths(travel_times, TRANSFER_MINUTES, "fair")
+                phase.count("stops_scored", len(scores))
+
+            with instrumentation.phase("best_paths", "Finding paths to the best stops"):
+                blocks = get_best_paths(connections, travel_times, scores[:MEETING_POINTS])
+
+            with instrumentation.phase("print", "Printing results"):
+                for block in blocks:
+                    for line in block:
+                        print(line)
+
+            with instrumentation.phase("save", "Saving results to file"):
+                # Paths of the best stops only, the other stops are saved with their scores
+                with open(RESULT_TEXT_FILE, "w", encoding="utf8") as f:
+                    for block in blocks:
+                        for line in block:
+                            f.write(line + "\n")
+                        f.write("\n")
+
+                    for (index, value) in enumerate(scores[MEETING_POINTS:], MEETING_POINTS):
+                        f.write(f"{index + 1}. {value[0]} ({value[1]})\n")
+
+    if arguments.metrics:
+        print(f"Saving metrics to {arguments.metrics}")
+        instrumentation.save(arguments.metrics)
+    if arguments.profile:
+        print(f"Saving profile to {arguments.profile}")
+        instrumentation.dump_profile(arguments.profile)
+
+
+def find_early_meeting_points(connections: ConnectionsAccess, start_stops: list, instrumentation: Instrumentation):
     """
-    Takes connections class and start stops list, finds all connections for each
-    start stop in a list and returns the result as a list of dictionaries.
+    Prints and saves the best meeting stops found by the early terminating search,
+    which stops as soon as they are known, instead of searching all paths from all start stops.
+    Only minutes are scored, the paths are the fastest ones from each start stop.
     """
-    all_paths = []
-    for start_stop in start_stops:
-        calculation = PathCalculations(connections, start_stop)
-        calculation.find_all_connections()
-        calculation.save()
-
-        results_list = calculation.get_results()
-        results_dict = {}
-        for (stop, distance, path) in results_list:
-            results_dict[stop] = {"distance_min": distance, "path": path, "transfers": "unknown"}
-
-        all_paths.append(results_dict)
-
-    return all_paths
+    with instrumentation.phase("meeting_points", "Finding the best meeting stops - the lower score the better") as phase:
+        search = MeetingPointSearch(connections, start_stops, MEETING_POINTS, "fair")
+        search.find_meeting_points()
+        phase.count("settled", search.get_settled_count())
+        phase.summary = f"{search.get_settled_count()} stops settled"
+
+    with instrumentation.phase("paths", "Finding paths to the meeting stops"):
+        point_to_point = PointToPointSearch(connections)
+        blocks = []  # Lines of each meeting stop
+        for (index, (stop, score)) in enumerate(search.get_results()):
+            blocks.append([f"{index + 1}. {stop} ({score})"])
+            for start_stop in start_stops:
+                (minutes, path) = point_to_point.find_path(start_stop, stop)
+                blocks[-1].append(f"\t - {minutes} minutes, path:  {path}")
+
+    with instrumentation.phase("print", "Printing results"):
+        for block in blocks:
+            for line in block:
+                print(line)
+
+    with instrumentation.phase("save", "Saving results to file"):
+        with open(RESULT_TEXT_FILE, "w", encoding="utf8") as f:
+            for block in blocks:
+                for line in block:
+                    f.write(line + "\n")
+                f.write("\n")
+
+
+def get_all_paths(travel_times: TravelTimes):
+    """
+    Takes travel times calculated for each start stop
+    and returns the results as a list of dictionaries by stop name.
+    Paths are rebuilt from them only when they are printed (see path_calculations.get_path).
+    """
+    return [{result[0]: result for result in results_list} for results_list in travel_times.results]
 
 
-def evaluate_paths(stops: list, all_paths: list, transfer_minutes: float, score_function):
+def get_best_paths(connections: ConnectionsAccess, travel_times: TravelTimes, scores: list) -> list:
+    """
+    Lines of each scored stop with the transfers and path from each start stop.
+    Paths are rebuilt from the results of the start stops, the travel times
+    looked up in the travel matrix have no results, so the fastest paths are found
+    by the point to point search, only for these stops.
+    """
+    graph = connections.get_graph()
+    point_to_point = PointToPointSearch(connections)
+    all_paths = get_all_paths(travel_times)
+    blocks = []  # Lines of each stop
+    for (index, (stop, score)) in enumerate(scores):
+        blocks.append([f"{index + 1}. {stop} ({score})"])
+        for (origin, results) in enumerate(all_paths):
+            if results:
+                path = get_path(results, stop)
+            else:
+                (_, path) = point_to_point.find_path(travel_times.origins[origin], stop)
+            blocks[-1].append(f"\t - {travel_times.transfers[origin][graph.get_id(stop)]} transfers, path:  {path}")
+
+    return blocks
+
+
+def evaluate_paths(travel_times: TravelTimes, transfer_minutes: float, scorer="fair", k: int = None):
     """
     Evaluates paths, returning a sorted tuple with the stop name and score.
     The lower score the better -> meaning its closer to everybody.
 
-    Takes all available stops, calculated paths, time it takes to make a transfer in minutes
-    and score function for calculation score out of distances.
-    """
-    scores = []
-    for stop in stops:
-        distances = []
-
-        for path in all_paths:
-            if not stop in path:
-                break
-            distances.append(path[stop]["distance_min"] + path[stop]["transfers"] * transfer_minutes)
-
-        if len(distances) == len(all_paths):
-            score = score_function(distances)
-            scores.append((stop, score))
-
-    scores.sort(key=lambda tup: tup[1])
-
-    return scores
-
-
-def score_function(values: list):
-    """
-    This function is more fair than simple sum. 
-    It takes into account also the deviation between each distance,
-    so nobody should be traveling more than the others.
+    Takes travel times from all start stops, time it takes to make a transfer in minutes,
+    scorer (name from meeting_point.SCORERS or a matrix scorer function)
+    and number of best stops to return (all reachable stops without it).
     """
-    sum_value = sum(values)
-    mean_value = sum_value / len(values)
-    deviations = [(x - mean_value)**2 for x in values]
+    scores = score_matrix(travel_times.minutes, travel_times.transfers, transfer_minutes, scorer)
 
-    return sum_value + sum(deviations)**0.5
+    return [(travel_times.stops[index], scores[index]) for index in top_k(scores, k)]
 
 
 if __name__ == "__main__":
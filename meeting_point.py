@@ -0,0 +1,242 @@
+from array import array
+import heapq
+import math
+from operator import add, mul
+from itertools import repeat
+
+from path_calculations import ConnectionsAccess
+
+
+# Scorers take the origins x stops matrix (one sequence per origin) and return a score for each stop.
+# They work row by row with map over whole rows, so the per stop work stays in C where possible.
+# The lower score the better, stops unreachable from any origin score inf.
+
+
+def sum_scorer(rows: list) -> list:
+    """
+    Total time of everybody.
+    """
+    total = list(rows[0])
+    for row in rows[1:]:
+        total = list(map(add, total, row))
+
+    return total
+
+
+def fair_scorer(rows: list) -> list:
+    """
+    This scorer is more fair than simple sum.
+    It takes into account also the deviation between each distance,
+    so nobody should be traveling more than the others.
+    Sum of squared deviations is computed as sum of squares - sum^2 / n.
+    """
+    count = len(rows)
+    total = sum_scorer(rows)
+    squares = list(map(mul, rows[0], rows[0]))
+    for row in rows[1:]:
+        squares = list(map(add, squares, map(mul, row, row)))
+
+    return [s + math.sqrt(max(q - s * s / count, 0.0)) if s != math.inf else math.inf for (s, q) in zip(total, squares)]
+
+
+def max_scorer(rows: list) -> list:
+    """
+    Minimax, the time of the one traveling the longest.
+    """
+    maximum = list(rows[0])
+    for row in rows[1:]:
+        maximum = list(map(max, maximum, row))
+
+    return maximum
+
+
+def percentile_scorer(percentile: float):
+    """
+    Scorer of the percentile (0-100, linear interpolation) of the times, e.g. 50 is the median.
+    """
+    def scorer(rows: list) -> list:
+        position = (len(rows) - 1) * percentile / 100
+        lower = math.floor(position)
+        upper = math.ceil(position)
+        fraction = position - lower
+
+        scores = []
+        for values in map(sorted, zip(*rows)):
+            if values[-1] == math.inf:
+                scores.append(math.inf)
+            else:
+                scores.append(values[lower] + (values[upper] - values[lower]) * fraction)
+
+        return scores
+
+    return scorer
+
+
+def list_scorer(score_function):
+    """
+    Scorer from a function scoring the list of all origins times of one stop (e.g. sum).
+    This is the slow way, the function is called for every stop.
+    """
+    def scorer(rows: list) -> list:
+        return [score_function(list(values)) if math.inf not in values else math.inf for values in zip(*rows)]
+
+    return scorer
+
+
+SCORERS = {
+    "sum": sum_scorer,
+    "fair": fair_scorer,
+    "max": max_scorer,
+    "median": percentile_scorer(50),
+    "p90": percentile_scorer(90),
+}
+
+
+def score_matrix(minutes: list, transfers: list = None, transfer_minutes: float = 0.0, scorer="fair") -> list:
+    """
+    Scores of all stops for the origins x stops minutes matrix,
+    with transfers x transfer minutes added, if the transfers matrix is given.
+    Scorer is a name from SCORERS or a matrix scorer function.
+    """
+    rows = minutes
+    if transfers is not None and transfer_minutes:
+        rows = [array("d", map(add, row, map(mul, transfer_row, repeat(transfer_minutes))))
+                for (row, transfer_row) in zip(minutes, transfers)]
+
+    if isinstance(scorer, str):
+        scorer = SCORERS[scorer]
+
+    return scorer(rows)
+
+
+def top_k(scores: list, k: int = None) -> list:
+    """
+    Indexes of the k best (lowest) finite scores in ascending order, all of them without k.
+    Uses a heap selection instead of sorting all the scores.
+    """
+    finite = [index for (index, score) in enumerate(scores) if score != math.inf]
+    if k is None:
+        return sorted(finite, key=scores.__getitem__)
+
+    return heapq.nsmallest(k, finite, key=scores.__getitem__)
+
+
+class MeetingPointSearch():
+    """
+    Class finds the k best meeting stops without searching the whole network.
+    Searches of all start stops run interleaved by distance (always expanding
+    the origin with the closest frontier), so each origin frontier radius is
+    a lower bound of all its not yet settled distances. Every built-in scorer
+    is non-decreasing in each time, so a stop score is bounded from below by
+    scoring its settled times together with the radii of the other origins.
+    The search stops once the k-th best exact score is not above any bound.
+    Only minutes are scored, transfers are not part of this search.
+    Start stops can also be GPS tuples (latitude, longitude), their search
+    starts by walking to the closest stops (see ConnectionsAccess.get_walking_legs).
+    """
+
+    def __init__(self, connections: ConnectionsAccess, start_stops: list, k: int = 10, scorer="fair", check_interval: int = 32):
+        if k < 1:
+            raise ValueError(f"Number of meeting points must be at least 1, not {k}")
+
+        self._connections = connections
+        self._graph = connections.get_graph()
+        self._start_stops = start_stops
+        self._k = k
+        self._scorer = SCORERS[scorer] if isinstance(scorer, str) else scorer
+        self._check_interval = check_interval
+        self._result = []  # [(Name, Score), ...]
+        self._settled_count = 0
+
+    def find_meeting_points(self):
+        graph = self._graph
+        stop_count = graph.get_stop_count()
+        origin_count = len(self._start_stops)
+
+        distances = [array("d", [math.inf]) * stop_count for _ in range(origin_count)]
+        settled = [bytearray(stop_count) for _ in range(origin_count)]
+        settled_origins = array("l", [0]) * stop_count  # Number of origins, which settled the stop
+        queues = []
+        for (origin, start_stop) in enumerate(self._start_stops):
+            if isinstance(start_stop, str):
+                start_legs = [(graph.get_id(start_stop), 0)]
+            else:
+                start_legs = [(graph.get_id(name), minutes) for (name, minutes) in self._connections.get_walking_legs(start_stop)]
+            queues.append([])
+            for (start_id, minutes) in start_legs:
+                distances[origin][start_id] = minutes
+                heapq.heappush(queues[origin], (minutes, start_id))
+
+        partial = set()  # Stops settled by some, but not all origins
+        complete = []  # Heap of the k best (-Score, Stop ID) of the stops settled by all origins
+        self._settled_count = 0
+
+        while True:
+            radii = [self._clean_radius(queue, settled[origin]) for (origin, queue) in enumerate(queues)]
+            origin = min(range(origin_count), key=radii.__getitem__)
+            if radii[origin] == math.inf:
+                break  # All searches are done
+
+            (distance, stop_id) = heapq.heappop(queues[origin])
+            settled[origin][stop_id] = 1
+            settled_origins[stop_id] += 1
+            self._settled_count += 1
+
+            if settled_origins[stop_id] == origin_count:
+                partial.discard(stop_id)
+                score = self._score([distances[o][stop_id] for o in range(origin_count)])
+                if len(complete) < self._k:
+                    heapq.heappush(complete, (-score, stop_id))
+                elif score < -complete[0][0]:
+                    heapq.heapreplace(complete, (-score, stop_id))
+            else:
+                partial.add(stop_id)
+
+            # Expand the closest
+            origin_distances = distances[origin]
+            origin_settled = settled[origin]
+            for edge in graph.get_connections(stop_id):
+                target = graph.targets[edge]
+                new_distance = distance + graph.distances_min[edge]
+                if not origin_settled[target] and new_distance < origin_distances[target]:
+                    origin_distances[target] = new_distance
+                    heapq.heappush(queues[origin], (new_distance, target))
+
+            if len(complete) == self._k and self._settled_count % self._check_interval == 0:
+                if -complete[0][0] <= self._lower_bound(partial, distances, settled, queues):
+                    break
+
+        self._result = sorted(((graph.names[stop_id], -score) for (score, stop_id) in complete), key=lambda tup: tup[1])
+
+    def get_results(self) -> list:
+        return self._result
+
+    def get_settled_count(self) -> int:
+        """
+        Number of (origin, stop) pairs settled, the full search settles origins x stops.
+        """
+        return self._settled_count
+
+    def _score(self, values: list) -> float:
+        return self._scorer([[value] for value in values])[0]
+
+    def _clean_radius(self, queue: list, origin_settled: bytearray) -> float:
+        """
+        Drop outdated entries from the queue top, returns the frontier radius.
+        """
+        while queue and origin_settled[queue[0][1]]:
+            heapq.heappop(queue)
+
+        return queue[0][0] if queue else math.inf
+
+    def _lower_bound(self, partial: set, distances: list, settled: list, queues: list) -> float:
+        """
+        The lowest score any not completely settled stop can still get.
+        """
+        radii = [self._clean_radius(queue, settled[origin]) for (origin, queue) in enumerate(queues)]
+        bound = self._score(radii)  # Stops not settled by any origin yet
+        for stop_id in partial:
+            values = [distances[o][stop_id] if settled[o][stop_id] else radii[o] for o in range(len(queues))]
+            bound = min(bound, self._score(values))
+
+        return bound
@@ -0,0 +1,123 @@
+import os
+
+from connections_graph import ConnectionsGraph
+from instrumentation import Instrumentation
+from network_cache import file_digests, load_network, network_key, save_network
+from pid_gtfs import PidGtfs
+from point_to_point import Landmarks
+
+
+GTFS_STOPS_FILE = "gtfs/stops.txt"
+GTFS_STOP_TIMES_FILE = "gtfs/stop_times.txt"
+GTFS_TRANSFERS_FILE = "gtfs/transfers.txt"
+GTFS_PATHWAYS_FILE = "gtfs/pathways.txt"
+CALCULATION_PARAMETERS = {"start_hour": 16, "stop_hour": 18, "trip_frequency_min": 6, "footpath_radius_m": 250}
+# Time windows of the network (trips by the hour of their first departure), they replace the hours of the parameters.
+# Trips after midnight are in the GTFS as hours 24-28 of the previous service day.
+TIME_WINDOWS = {
+    "morning": {"start_hour": 6, "stop_hour": 8, "trip_frequency_min": 6},
+    "afternoon": {"start_hour": 16, "stop_hour": 18, "trip_frequency_min": 6},
+    "evening": {"start_hour": 19, "stop_hour": 22, "trip_frequency_min": 4},
+    "night": {"start_hour": 23, "stop_hour": 28, "trip_frequency_min": 2},
+}
+
+NETWORK_FILE = "output/network.bin"
+INPUT_DIGESTS_FILE = "output/input_digests.json"
+BUILD_STATE_FILE = "output/build_state.pickle"
+HOURLY_BUCKETS_FILE = "output/hourly_buckets.pickle"
+LANDMARKS_FILE = "output/landmarks.bin"
+TRAVEL_MATRIX_FILE = "output/travel_matrix.bin"
+PATH_CACHE_DIRECTORY = "output/cache"
+RESULT_STOPS_JSON_FILE = "output/connections.json"
+RESULT_TRIPS_JSON_FILE = "output/trips.json"
+
+TRANSFER_MINUTES = 2
+
+
+def has_gtfs_feed() -> bool:
+    """
+    The GTFS feed to calculate the network from is downloaded.
+    """
+    return all(os.path.exists(gtfs_file) for gtfs_file in [GTFS_STOPS_FILE, GTFS_STOP_TIMES_FILE])
+
+
+def load_or_calculate_network(instrumentation: Instrumentation = None, parameters: dict = None):
+    """
+    Returns the compiled graph, trips and the network version key from the network file.
+    The network is recalculated and saved, if the file is missing or stale,
+    i.e. the GTFS input files or calculation parameters (CALCULATION_PARAMETERS without them) changed.
+    The network is composed from the hourly buckets of the feed, which are calculated
+    in one pass over the feed and saved, so other time windows do not read the feed again.
+    A changed feed is applied as an update of the last build, if its state
+    with the same calculation parameters is saved.
+    Without the GTFS feed the last JSON results are used, whatever the parameters are.
+    The calculation phases are measured by the instrumentation, if given.
+    """
+    if parameters is None:
+        parameters = CALCULATION_PARAMETERS
+
+    gtfs_files = [GTFS_STOPS_FILE, GTFS_STOP_TIMES_FILE]
+    if not has_gtfs_feed():
+        print(f"GTFS feed not found, load last results from {RESULT_STOPS_JSON_FILE} and {RESULT_TRIPS_JSON_FILE}")
+        pid_gtfs = PidGtfs(instrumentation)
+        pid_gtfs.load(RESULT_STOPS_JSON_FILE, RESULT_TRIPS_JSON_FILE)
+        key = network_key(file_digests([RESULT_STOPS_JSON_FILE, RESULT_TRIPS_JSON_FILE], INPUT_DIGESTS_FILE), {})
+        return (ConnectionsGraph.from_json(pid_gtfs.get_results()), pid_gtfs.get_trips(), key)
+
+    # Footpath files are optional
+    footpath_files = [gtfs_file for gtfs_file in [GTFS_TRANSFERS_FILE, GTFS_PATHWAYS_FILE] if os.path.exists(gtfs_file)]
+    # The files are only hashed again when their size or modification time changed
+    input_digests = file_digests(gtfs_files + footpath_files, INPUT_DIGESTS_FILE)
+    key = network_key(input_digests, parameters)
+
+    print(f"Load network from {NETWORK_FILE}")
+    network = load_network(NETWORK_FILE, key)
+    if network is not None:
+        print("Network loaded")
+        return network + (key,)
+
+    print("Network file missing or stale, must recalculate")
+    pid_gtfs = PidGtfs(instrumentation)
+    buckets_key = network_key(input_digests, {"footpath_radius_m": parameters["footpath_radius_m"]})
+    window = (parameters["start_hour"], parameters["stop_hour"], parameters["trip_frequency_min"])
+    if pid_gtfs.load_buckets(HOURLY_BUCKETS_FILE, buckets_key):
+        print(f"Hourly buckets loaded from {HOURLY_BUCKETS_FILE}")
+        pid_gtfs.compose(*window)
+    else:
+        try:
+            pid_gtfs.load_state(BUILD_STATE_FILE)
+        except FileNotFoundError:
+            pass
+
+        if pid_gtfs.can_update(**parameters):
+            print(f"Update the last build from {BUILD_STATE_FILE}")
+            pid_gtfs.update(input_stops=GTFS_STOPS_FILE, input_stop_times=GTFS_STOP_TIMES_FILE,
+                            input_transfers=GTFS_TRANSFERS_FILE, input_pathways=GTFS_PATHWAYS_FILE)
+        else:
+            pid_gtfs.calculate_buckets(input_stops=GTFS_STOPS_FILE, input_stop_times=GTFS_STOP_TIMES_FILE,
+                                       footpath_radius_m=parameters["footpath_radius_m"],
+                                       input_transfers=GTFS_TRANSFERS_FILE, input_pathways=GTFS_PATHWAYS_FILE)
+            print(f"Saving hourly buckets to {HOURLY_BUCKETS_FILE}")
+            pid_gtfs.save_buckets(HOURLY_BUCKETS_FILE, buckets_key)
+            pid_gtfs.compose(*window)
+
+    print(f"Saving results to {NETWORK_FILE}, {BUILD_STATE_FILE}, {RESULT_STOPS_JSON_FILE} and {RESULT_TRIPS_JSON_FILE}")
+    graph = ConnectionsGraph.from_json(pid_gtfs.get_results())
+    save_network(NETWORK_FILE, key, graph, pid_gtfs.get_trips())
+    pid_gtfs.save_state(BUILD_STATE_FILE)
+    pid_gtfs.save(RESULT_STOPS_JSON_FILE, RESULT_TRIPS_JSON_FILE)
+
+    return (graph, pid_gtfs.get_trips(), key)
+
+
+def load_or_calculate_landmarks(graph: ConnectionsGraph, key: bytes) -> Landmarks:
+    """
+    ALT landmarks of the network for point to point queries, calculated and saved once per network version.
+    """
+    landmarks = Landmarks.load(LANDMARKS_FILE, key)
+    if landmarks is None:
+        print(f"Calculating landmarks, saving them to {LANDMARKS_FILE}")
+        landmarks = Landmarks.from_graph(graph)
+        landmarks.save(LANDMARKS_FILE, key)
+
+    return landmarks
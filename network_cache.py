@@ -0,0 +1,162 @@
+from array import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+from connections_graph import ConnectionsGraph
+
+
+# Binary compiled network layout (little endian, sections aligned to 8 bytes):
+#   header, string table offsets (uint32) and UTF-8 blob,
+#   latitudes, longitudes (float64), CSR offsets, targets (int32),
+#   distances in minutes and km (float64), walking flags (uint8),
+#   trip offsets and trip stop IDs (int32)
+NETWORK_MAGIC = b"PIDNET\0\0"
+NETWORK_VERSION = 2
+_HEADER = struct.Struct("<8sI32sIIIII")
+_ALIGNMENT = 8
+
+
+def file_digests(input_files: list, digests_file: str = None) -> list:
+    """
+    SHA-256 of the content of each input file, returns [(file name, hex digest), ...].
+    With digests_file the digests are kept there with the size and modification time of each file
+    and reused while they match, so the unchanged (large) files are not read on every start.
+    """
+    saved = {}
+    if digests_file is not None:
+        try:
+            with open(digests_file, encoding="utf8") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass  # Missing or broken file, all the files are hashed
+
+    digests = []
+    changed = False
+    for input_file in input_files:
+        stat = os.stat(input_file)
+        path = os.path.abspath(input_file)
+        entry = saved.get(path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            digest = hashlib.sha256()
+            with open(input_file, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+            saved[path] = entry
+            changed = True
+        digests.append((os.path.basename(input_file), entry["sha256"]))
+
+    if digests_file is not None and changed:
+        temporary_file = digests_file + ".tmp"
+        with open(temporary_file, "w", encoding="utf8") as f:
+            json.dump(saved, f, ensure_ascii=False, indent=4)
+        os.replace(temporary_file, digests_file)
+
+    return digests
+
+
+def network_key(input_digests: list, parameters: dict) -> bytes:
+    """
+    Hash of the GTFS input files content (see file_digests), the calculation parameters and the cache version.
+    Any change in them makes the saved network stale.
+    """
+    digest = hashlib.sha256()
+    digest.update(str(NETWORK_VERSION).encode())
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    for (name, file_digest) in input_digests:
+        digest.update(name.encode())
+        digest.update(file_digest.encode())
+
+    return digest.digest()
+
+
+def save_network(network_file: str, key: bytes, graph: ConnectionsGraph, trips: list):
+    """
+    Save the compiled graph and the trips (lists of stop names) to a binary network file.
+    """
+    names = [name.encode("utf8") for name in graph.names]
+    name_offsets = array("I", [0])
+    for name in names:
+        name_offsets.append(name_offsets[-1] + len(name))
+
+    trip_offsets = array("i", [0])
+    trip_stops = array("i")
+    for trip in trips:
+        trip_stops.extend(graph.get_id(stop) for stop in trip)
+        trip_offsets.append(len(trip_stops))
+
+    header = _HEADER.pack(NETWORK_MAGIC, NETWORK_VERSION, key, graph.get_stop_count(), graph.get_connection_count(),
+                          len(trips), len(trip_stops), name_offsets[-1])
+
+    sections = [name_offsets.tobytes(), b"".join(names),
+                array("d", graph.latitudes).tobytes(), array("d", graph.longitudes).tobytes(),
+                array("i", graph.offsets).tobytes(), array("i", graph.targets).tobytes(),
+                array("d", graph.distances_min).tobytes(), array("d", graph.distances_km).tobytes(),
+                bytes(graph.walking), trip_offsets.tobytes(), trip_stops.tobytes()]
+
+    # Write to a temporary file first, so a running reader never sees a half written network
+    temporary_file = network_file + ".tmp"
+    with open(temporary_file, "wb") as f:
+        f.write(_pad(header))
+        for section in sections:
+            f.write(_pad(section))
+    os.replace(temporary_file, network_file)
+
+
+def load_network(network_file: str, key: bytes):
+    """
+    Map the binary network file into memory without copying the arrays.
+    Returns (ConnectionsGraph, trips) or None, if the file is missing, stale or of another version.
+    """
+    try:
+        with open(network_file, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None  # Missing or empty file
+
+    if len(data) < _HEADER.size:
+        return None
+
+    (magic, version, file_key, stop_count, connection_count, trip_count, trip_stop_count, names_size) = _HEADER.unpack_from(data)
+    if magic != NETWORK_MAGIC or version != NETWORK_VERSION or file_key != key:
+        return None
+
+    view = memoryview(data)
+    position = _aligned(_HEADER.size)
+
+    def section(size: int, item_format: str = "B") -> memoryview:
+        nonlocal position
+        item_size = struct.calcsize(item_format)
+        values = view[position:position + size * item_size].cast(item_format)
+        position = _aligned(position + size * item_size)
+        return values
+
+    name_offsets = section(stop_count + 1, "I")
+    names_blob = section(names_size)
+    names = [str(names_blob[name_offsets[i]:name_offsets[i + 1]], "utf8") for i in range(stop_count)]
+
+    latitudes = section(stop_count, "d")
+    longitudes = section(stop_count, "d")
+    offsets = section(stop_count + 1, "i")
+    targets = section(connection_count, "i")
+    distances_min = section(connection_count, "d")
+    distances_km = section(connection_count, "d")
+    walking = section(connection_count)
+    trip_offsets = section(trip_count + 1, "i")
+    trip_stops = section(trip_stop_count, "i")
+
+    graph = ConnectionsGraph(names, latitudes, longitudes, offsets, targets, distances_min, distances_km, walking)
+    trips = [[names[stop] for stop in trip_stops[trip_offsets[i]:trip_offsets[i + 1]]] for i in range(trip_count)]
+
+    return (graph, trips)
+
+
+def _aligned(position: int) -> int:
+    return (position + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _pad(section: bytes) -> bytes:
+    return section + b"\0" * (_aligned(len(section)) - len(section))
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import shutil
+import zlib
+
+
+RESULTS_VERSION = 3  # Format of the cached results, older directories are removed as stale
+
+
+class PathCache():
+    """
+    Cache of single start stop path results (PathCalculations.get_results).
+    Recently used results are kept in memory (LRU), all of them are stored
+    compressed on disk in a directory of the network version, so they are
+    shared across runs and processes. Directories of other network versions
+    (e.g. other time windows) are kept, only the ones of other results versions are removed.
+    All the directories together are capped at disk_bytes, evicting the least
+    recently used directories of other networks first, then the least recently
+    used files of this one.
+    """
+
+    def __init__(self, directory: str, network_key: bytes, memory_items: int = 16, disk_bytes: int = 64 << 20):
+        self._root = directory
+        self._directory = os.path.join(directory, f"{network_key.hex()[:16]}.{RESULTS_VERSION}")
+        self._memory = OrderedDict()  # (Start stop, Mode): results
+        self._memory_items = memory_items
+        self._disk_bytes = disk_bytes
+
+        os.makedirs(self._directory, exist_ok=True)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.endswith(f".{RESULTS_VERSION}") and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)  # Stale results version
+
+    def get(self, start_stop: str, mode: str):
+        """
+        Results of the start stop for the search mode, None if not cached.
+        """
+        key = (start_stop, mode)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                results = json.loads(zlib.decompress(f.read()).decode("utf8"))
+        except (FileNotFoundError, zlib.error, ValueError):
+            return None
+
+        os.utime(path)  # Mark as recently used for the disk eviction
+        self._remember(key, results)
+        return results
+
+    def put(self, start_stop: str, mode: str, results: list):
+        key = (start_stop, mode)
+        self._remember(key, results)
+
+        data = zlib.compress(json.dumps(results, ensure_ascii=False, separators=(",", ":")).encode("utf8"))
+        path = self._get_path(key)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+
+        self._evict_disk()
+
+    def _remember(self, key: tuple, results: list):
+        self._memory[key] = results
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_items:
+            self._memory.popitem(last=False)
+
+    def _get_path(self, key: tuple) -> str:
+        name = hashlib.sha1("\0".join(map(str, key)).encode("utf8")).hexdigest()
+        return os.path.join(self._directory, name + ".json.z")
+
+    def _evict_disk(self):
+        entries = self._list_files(self._directory)
+        total = sum(size for (_, size, _) in entries)
+
+        # Other network versions as whole directories, by their last use
+        others = []
+        for name in os.listdir(self._root):
+            path = os.path.join(self._root, name)
+            if path != self._directory and os.path.isdir(path):
+                files = self._list_files(path)
+                others.append((max((mtime for (mtime, _, _) in files), default=0.0), sum(size for (_, size, _) in files), path))
+        total += sum(size for (_, size, _) in others)
+
+        for (_, size, path) in sorted(others):
+            if total <= self._disk_bytes:
+                return
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+        for (_, size, path) in sorted(entries):
+            if total <= self._disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _list_files(self, directory: str) -> list:
+        """
+        Files of the directory as [(mtime, size, path), ...].
+        """
+        entries = []
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return entries  # Removed by another process
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # Removed by another process
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
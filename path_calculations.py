@@ -1,5 +1,17 @@
+from array import array
+from dataclasses import dataclass
+import heapq
 import math
 import json
+import multiprocessing
+
+from connections_graph import ConnectionsGraph, RidesGraph
+from instrumentation import Instrumentation
+from path_cache import PathCache
+from spatial_index import SpatialIndex, WALKING_SPEED_KMH, walking_minutes
+
+
+WALKING_STOP_COUNT = 3  # Stops walked to from an origin given by GPS
 
 
 # Source: https://janakiev.com/blog/gps-points-distance-python/
@@ -29,12 +41,67 @@ class ConnectionsAccess():
 
     def __init__(self, json_data: dict):
         self._json_data = json_data
+        self._graph = None
+        self._spatial_index = None
+
+    @classmethod
+    def from_graph(cls, graph: ConnectionsGraph):
+        """
+        Access to an already compiled graph (e.g. a loaded network file).
+        The JSON form is only recreated if some of its methods is used.
+        """
+        access = cls(None)
+        access._graph = graph
+        return access
+
+    def get_graph(self) -> ConnectionsGraph:
+        """
+        Compiled graph for the path engines, built once on first use.
+        """
+        if self._graph is None:
+            self._graph = ConnectionsGraph.from_json(self._json_data)
+
+        return self._graph
+
+    def get_spatial_index(self) -> SpatialIndex:
+        """
+        Grid index of the stop coordinates, built once on first use.
+        """
+        if self._spatial_index is None:
+            graph = self.get_graph()
+            self._spatial_index = SpatialIndex(graph.latitudes, graph.longitudes)
+
+        return self._spatial_index
+
+    def get_nearest_stops(self, gps: tuple, count: int = 1) -> list:
+        """
+        The count stops closest to the GPS (latitude, longitude), returns [(Name, meters), ...].
+        """
+        names = self.get_graph().names
+        return [(names[stop_id], meters) for (stop_id, meters) in self.get_spatial_index().nearest(gps, count)]
+
+    def get_stops_within(self, gps: tuple, radius_m: float) -> list:
+        """
+        Stops not farther than radius_m meters from the GPS (latitude, longitude), returns [(Name, meters), ...].
+        """
+        names = self.get_graph().names
+        return [(names[stop_id], meters) for (stop_id, meters) in self.get_spatial_index().within(gps, radius_m)]
+
+    def get_walking_legs(self, gps: tuple, count: int = WALKING_STOP_COUNT, speed_kmh: float = WALKING_SPEED_KMH) -> list:
+        """
+        Walking from the GPS (latitude, longitude) to the count closest stops, returns [(Name, minutes), ...].
+        """
+        return [(name, walking_minutes(meters, speed_kmh)) for (name, meters) in self.get_nearest_stops(gps, count)]
 
     def get_stops(self) -> list:
+        if self._json_data is None:
+            graph = self._graph
+            return [name for (index, name) in enumerate(graph.names) if not math.isnan(graph.latitudes[index])]
+
         return list(self._json_data.keys())
 
     def get_gps(self, stop: str) -> tuple:
-        return (self._json_data[stop]["latitude"], self._json_data[stop]["longitude"])
+        return (self._get_json_data()[stop]["latitude"], self._get_json_data()[stop]["longitude"])
 
     def get_distance_gps(self, stop_1: str, stop_2: str) -> float:
         (x1, y1) = self.get_gps(stop_1)
@@ -45,13 +112,41 @@ class ConnectionsAccess():
         return _haversine(self.get_gps(stop_1), self.get_gps(stop_2))
 
     def get_connections(self, stop: str) -> list:
-        return list(self._json_data[stop]["connections"].keys())
+        return list(self._get_json_data()[stop]["connections"].keys())
+
+    def get_footpaths(self, stop: str) -> list:
+        return list(self._get_json_data()[stop].get("footpaths", {}).keys())
 
     def get_connection_distance_km(self, stop: str, connection: str) -> float:
-        return self._json_data[stop]["connections"][connection]["distance_km"]
+        return self._get_json_data()[stop]["connections"][connection]["distance_km"]
 
     def get_connection_distance_min(self, stop: str, connection: str) -> float:
-        return self._json_data[stop]["connections"][connection]["distance_min"]
+        return self._get_json_data()[stop]["connections"][connection]["distance_min"]
+
+    def _get_json_data(self) -> dict:
+        if self._json_data is None:
+            self._json_data = self._graph.to_json()
+
+        return self._json_data
+
+
+def get_path(results_by_stop: dict, stop: str) -> list:
+    """
+    Path to the stop rebuilt from the results of one start stop by stop name.
+    The last item of each result is the via list: the path to its first stop
+    is the beginning of the path, the rest are the stops in between,
+    e.g. [Previous Stop] for PathCalculations, [] for the start stop.
+    """
+    path = []
+    while True:
+        path.append(stop)
+        via = results_by_stop[stop][-1]
+        if not via:
+            break
+        path.extend(reversed(via[1:]))
+        stop = via[0]
+
+    return path[::-1]
 
 
 class PathCalculations():
@@ -59,73 +154,355 @@ class PathCalculations():
     Class calculates all paths in connection stops.
     It saves sorted JSON with all the available connections 
     from a stop.
+    The start can also be a GPS tuple (latitude, longitude),
+    then the search starts by walking to the closest stops.
+    Only the predecessors are kept in the search, paths are rebuilt on demand (see get_path).
     """
 
     def __init__(self, connections: ConnectionsAccess, stop: str):
         self._connections = connections
-        self._map = {}  # Dictionary of all stops and if the were processed
-        self._stops_queue = []
-        self._result = [] # [(Name, Total Distance, [Path]), ...]
+        self._graph = connections.get_graph()
+        self._distances = None  # Best known distance to each stop ID
+        self._settled = None  # Flag for each stop ID, if it was processed
+        self._predecessors = None  # Previous stop ID on the best known path to each stop ID
+        self._stops_queue = []  # Heap of (Total Distance, Order, ID)
+        self._result = [] # [(Name, Total Distance, [Previous Stop]), ...]
         self._start_stop = stop
+        self._order = 0  # Number of heap pushes, it breaks the ties too
+        self._settled_count = 0
 
     def find_all_connections(self):
         """
-        Breadth-first search throudh all the stops.
-        Saves them in ascending order.
+        Dijkstra search through all the stops.
+        Stops are settled when popped from the heap (lazy decrease-key),
+        so the results are saved in ascending order with exact shortest times.
         """
         self._initialize_map()
         self._stops_queue = []
+        self._result = []
+        self._order = 0
 
-        # Set start stop as visited
-        self._map[self._start_stop] = False
-        # Append the start stop to results with zero time
-        # (Name, Total Distance, [Path])
-        self._stops_queue.append((self._start_stop, 0, [self._start_stop]))
+        # Append the start stops to queue with their walking time
+        for (start_id, minutes) in self._get_start_legs():
+            self._distances[start_id] = minutes
+            self._push(minutes, start_id)
 
+        names = self._graph.names
+        predecessors = self._predecessors
         while self._stops_queue:
-            # Sort
-            self._stops_queue.sort(key=lambda tup: tup[1], reverse=True)
+            (distance, _, stop_id) = heapq.heappop(self._stops_queue)
 
-            # Safe the closest in result list
-            self._result.append(self._stops_queue.pop())
+            # Skip outdated entries of already settled stops
+            if self._settled[stop_id]:
+                continue
+
+            # Settle the closest and safe it in result list
+            self._settled[stop_id] = 1
+            via = [names[predecessors[stop_id]]] if predecessors[stop_id] != -1 else []
+            self._result.append((names[stop_id], round(distance, 1), via))
 
             # Expand the closest
-            self._expand()
+            self._expand(stop_id, distance)
+
+        self._settled_count = self._settled.count(1)
 
-    def get_results(self) -> dict:
+    def get_results(self) -> list:
         return self._result
 
+    def get_counters(self) -> dict:
+        """
+        Work done by the last search, for the instrumentation.
+        """
+        return {"settled": self._settled_count, "heap_pushes": self._order}
+
+    def get_path(self, stop: str) -> list:
+        return get_path({result[0]: result for result in self._result}, stop)
+
     def save(self, results_json: str = ""):
         if results_json == "":
-            results_json = "output/" + self._start_stop + ".json"
+            results_json = "output/" + self._get_start_name() + ".json"
 
         with open(results_json, 'w', encoding="utf8") as f:
             json.dump(self._result, f, ensure_ascii=False, sort_keys=True, indent=4)
 
     def load(self, results_json: str = ""):
         if results_json == "":
-            results_json = "output/" + self._start_stop + ".json"
+            results_json = "output/" + self._get_start_name() + ".json"
 
         with open(results_json, encoding="utf8") as f:
             self._result = json.load(f)
 
+    def _get_start_name(self) -> str:
+        if isinstance(self._start_stop, str):
+            return self._start_stop
+
+        return f"{self._start_stop[0]},{self._start_stop[1]}"
+
+    def _get_start_legs(self) -> list:
+        """
+        Start stop IDs with the minutes to get there, [(Stop ID, minutes), ...].
+        """
+        if isinstance(self._start_stop, str):
+            return [(self._graph.get_id(self._start_stop), 0)]
+
+        return [(self._graph.get_id(name), minutes) for (name, minutes) in self._connections.get_walking_legs(self._start_stop)]
+
     def _initialize_map(self):
         """
-        Set all stops as true.
+        Set all stops as not reached yet.
+        """
+        count = self._graph.get_stop_count()
+        self._distances = array("d", [math.inf]) * count
+        self._settled = bytearray(count)
+        self._predecessors = array("l", [-1]) * count
+
+    def _push(self, distance: float, stop_id: int):
+        # The order breaks ties in the order of discovery
+        heapq.heappush(self._stops_queue, (distance, self._order, stop_id))
+        self._order += 1
+
+    def _expand(self, stop_id: int, distance: float):
+        """
+        Expand the settled stop, add improved connections to queue.
+        """
+        graph = self._graph
+        targets = graph.targets
+        distances_min = graph.distances_min
+        for edge in range(graph.offsets[stop_id], graph.offsets[stop_id + 1]):
+            target = targets[edge]
+            if self._settled[target]:
+                continue
+
+            new_distance = distance + distances_min[edge]
+            if new_distance < self._distances[target]:
+                self._distances[target] = new_distance
+                self._predecessors[target] = stop_id
+                self._push(new_distance, target)
+
+
+class TransferPathCalculations(PathCalculations):
+    """
+    Class calculates all paths in connection stops, charging
+    the transfer penalty already during the search.
+    The search state is a stop and the ride (trip) the traveler is on,
+    so the found paths are optimal for minutes plus transfer penalty.
+    """
+
+    def __init__(self, connections: ConnectionsAccess, stop: str, rides: RidesGraph, transfer_minutes: float):
+        super().__init__(connections, stop)
+        self._rides = rides
+        self._transfer_minutes = transfer_minutes
+        self._stops_queue = []  # Heap of (Cost, Boardings, Order, State)
+        self._result = []  # [(Name, Total Distance, Transfers, [Via Stops]), ...]
+
+    def find_all_connections(self):
+        """
+        Dijkstra search through the (stop, ride) states.
+        States 0..N-1 are "at stop", state N + position is "on board at ride position".
+        Footpaths lead from a stop state directly to another stop state.
+        Every boarding except the first one costs the transfer penalty, the first ride is not a transfer,
+        so a walk is not preferred to a faster ride.
+        Results keep the stop, where the last ride was boarded (or the walk started),
+        and the stops ridden through since, the paths are rebuilt from them (see get_path).
         """
-        self._map = {}
-        for stop in self._connections.get_stops():
-            self._map[stop] = True
+        graph = self._graph
+        rides = self._rides
+        stop_count = graph.get_stop_count()
+        state_count = stop_count + rides.get_position_count()
+        penalty = self._transfer_minutes
+
+        costs = array("d", [math.inf]) * state_count
+        minutes = array("d", [0.0]) * state_count
+        boardings = array("l", [0]) * state_count
+        predecessors = array("l", [-1]) * state_count
+        settled = bytearray(state_count)
+
+        self._stops_queue = []
+        self._result = []
+        order = 0
+
+        for (start_id, walk_minutes) in self._get_start_legs():
+            costs[start_id] = walk_minutes
+            minutes[start_id] = walk_minutes
+            order += 1
+            heapq.heappush(self._stops_queue, (walk_minutes, 0, order, start_id))
+
+        def relax(state: int, cost: float, state_minutes: float, state_boardings: int, predecessor: int):
+            nonlocal order
+            if cost < costs[state]:
+                costs[state] = cost
+                minutes[state] = state_minutes
+                boardings[state] = state_boardings
+                predecessors[state] = predecessor
+                order += 1
+                heapq.heappush(self._stops_queue, (cost, state_boardings, order, state))
 
-    def _expand(self):
+        while self._stops_queue:
+            (cost, _, _, state) = heapq.heappop(self._stops_queue)
+            if settled[state]:
+                continue
+            settled[state] = 1
+
+            if state < stop_count:
+                # At stop, save it in result list and board all the rides stopping here
+                transfers = max(boardings[state] - 1, 0)
+                self._result.append((graph.names[state], round(minutes[state], 1), transfers, self._get_via(state, predecessors)))
+
+                boarding_cost = cost + penalty if boardings[state] > 0 else cost
+                for boarding in range(rides.boarding_offsets[state], rides.boarding_offsets[state + 1]):
+                    position = rides.boarding_positions[boarding]
+                    relax(stop_count + position, boarding_cost, minutes[state], boardings[state] + 1, state)
+
+                # Walk the footpaths to other stops, walking is not a boarding
+                for edge in graph.get_connections(state):
+                    if graph.walking[edge]:
+                        walk_minutes = graph.distances_min[edge]
+                        relax(graph.targets[edge], cost + walk_minutes, minutes[state] + walk_minutes, boardings[state], state)
+            else:
+                # On board, alight here or ride to the next stop
+                position = state - stop_count
+                relax(rides.position_stops[position], cost, minutes[state], boardings[state], state)
+
+                ride_minutes = rides.position_minutes[position]
+                if ride_minutes != math.inf:
+                    relax(state + 1, cost + ride_minutes, minutes[state] + ride_minutes, boardings[state], state)
+
+        self._order = order
+        self._settled_count = settled.count(1)
+
+    def _get_via(self, state: int, predecessors: array) -> list:
         """
-        Expand the last stop from results, add to queue.
+        Stop names from the previous "at stop" state to the "at stop" state (excluded),
+        boarding and alighting states are merged. Empty for the start stops.
         """
-        current_stop = self._result[-1]
-        connections_list = self._connections.get_connections(current_stop[0])
-        for connection in connections_list:
-            if self._map.get(connection, False):
-                # (Name, Total Distance, [Path])
-                self._stops_queue.append((connection, round(current_stop[1] + self._connections.get_connection_distance_min(current_stop[0], connection), 1), current_stop[2] + [connection]))
-                # Set stops as processed
-                self._map[connection] = False
+        stop_count = self._graph.get_stop_count()
+        position_stops = self._rides.position_stops
+
+        via = [state]
+        state = predecessors[state]
+        if state == -1:
+            return []
+
+        while state >= stop_count:
+            stop_id = position_stops[state - stop_count]
+            if via[-1] != stop_id:
+                via.append(stop_id)
+            state = predecessors[state]
+        if via[-1] != state:
+            via.append(state)
+
+        return [self._graph.names[stop_id] for stop_id in reversed(via[1:])]
+
+
+@dataclass
+class TravelTimes:
+    """
+    Results of path calculations from more origins at once.
+    Minutes and transfers are dense origins x stops matrices (one array per origin),
+    the stop columns are in the order of stops, unreachable stops have inf minutes.
+    """
+    origins: list
+    stops: list
+    minutes: list  # array("d") for each origin
+    transfers: list  # array("l") for each origin
+    results: list  # get_results() of each origin
+
+    @classmethod
+    def from_results(cls, graph: ConnectionsGraph, origins: list, all_results: list, with_transfers: bool):
+        """
+        Dense matrices from the results of each origin,
+        with_transfers for the results of TransferPathCalculations.
+        """
+        travel_times = cls(origins=list(origins), stops=graph.names, minutes=[], transfers=[], results=all_results)
+        for results in all_results:
+            minutes = array("d", [math.inf]) * graph.get_stop_count()
+            transfers = array("l", [0]) * graph.get_stop_count()
+            for result in results:
+                stop_id = graph.get_id(result[0])
+                minutes[stop_id] = result[1]
+                if with_transfers:
+                    transfers[stop_id] = result[2]
+
+            travel_times.minutes.append(minutes)
+            travel_times.transfers.append(transfers)
+
+        return travel_times
+
+
+# Shared read-only state of the batch worker processes, inherited on fork (copy-on-write)
+_batch_state = None
+
+
+def calculate_all_origins(connections: ConnectionsAccess, start_stops: list, rides: RidesGraph = None,
+                          transfer_minutes: float = 0.0, save: bool = False, processes: int = None,
+                          cache: PathCache = None, instrumentation: Instrumentation = None) -> TravelTimes:
+    """
+    Finds all connections from each of the start stops in parallel worker processes.
+    With rides the transfer aware search is used, otherwise minutes only.
+    The workers share the compiled graph by fork; where fork is not available,
+    or for a single process, the origins are calculated one after another.
+    Results found in the cache are not calculated again, new ones are added to it.
+    Start stops can also be GPS tuples (latitude, longitude), see PathCalculations.
+    The search counters of all origins are added to the instrumentation.
+    """
+    global _batch_state
+    mode = "minutes" if rides is None else f"transfers-{transfer_minutes}"
+
+    cached_results = {}
+    if cache is not None:
+        for start_stop in start_stops:
+            results = cache.get(start_stop, mode)
+            if results is not None:
+                cached_results[start_stop] = results
+    missing_stops = [start_stop for start_stop in dict.fromkeys(start_stops) if start_stop not in cached_results]
+
+    if processes is None:
+        processes = min(len(missing_stops), multiprocessing.cpu_count())
+
+    _batch_state = (connections, rides, transfer_minutes, save)
+    try:
+        if processes > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                missing_results = pool.map(_calculate_origin, missing_stops)
+        else:
+            missing_results = [_calculate_origin(start_stop) for start_stop in missing_stops]
+    finally:
+        _batch_state = None
+
+    for (start_stop, (results, counters)) in zip(missing_stops, missing_results):
+        cached_results[start_stop] = results
+        if cache is not None:
+            cache.put(start_stop, mode, results)
+        if instrumentation is not None:
+            for (counter, value) in counters.items():
+                instrumentation.count(counter, value)
+    if instrumentation is not None:
+        instrumentation.count("origins_calculated", len(missing_stops))
+        instrumentation.count("origins_cached", len(dict.fromkeys(start_stops)) - len(missing_stops))
+    all_results = [cached_results[start_stop] for start_stop in start_stops]
+
+    return TravelTimes.from_results(connections.get_graph(), start_stops, all_results, rides is not None)
+
+
+def create_calculation(connections: ConnectionsAccess, start_stop: str, rides: RidesGraph = None,
+                       transfer_minutes: float = 0.0) -> PathCalculations:
+    """
+    Path calculation of the start stop with all connections found.
+    With rides the transfer aware search is used, otherwise minutes only.
+    """
+    if rides is None:
+        calculation = PathCalculations(connections, start_stop)
+    else:
+        calculation = TransferPathCalculations(connections, start_stop, rides, transfer_minutes)
+    calculation.find_all_connections()
+
+    return calculation
+
+
+def _calculate_origin(start_stop: str) -> tuple:
+    (connections, rides, transfer_minutes, save) = _batch_state
+    calculation = create_calculation(connections, start_stop, rides, transfer_minutes)
+    if save:
+        calculation.save()
+
+    return (calculation.get_results(), calculation.get_counters())
@@ -2,6 +2,13 @@ import csv
 from dataclasses import dataclass, field
 from datetime import datetime
 import json
+import os
+import pickle
+
+from instrumentation import Instrumentation
+from spatial_index import SpatialIndex, haversine_many, walking_minutes
+from stop_times import read_stop_times
+from timetable import Timetable
 
 
 @dataclass
@@ -34,6 +41,7 @@ class Trip:
     id: str
     trip_stops: list = field(default_factory=list)  # TripStop
     frequency: int = 1
+    hour: int = 0  # Hour of the first departure
 
 
 @dataclass
@@ -71,44 +79,311 @@ class Stop:
     Each stop with unique name can incorporate more stop IDs.
     The position is the middle of all StopIds GPS coordinates.
     And there are the connections the Stop has to different Stops ny name.
+    Footpaths are the Stops in walking distance, also as Connections by name.
     """
     name: str
     lon: float = 0.0
     lat: float = 0.0
     ids: list = field(default_factory=list)  # StopId
     connections: dict = field(default_factory=dict)  # name: Connection
+    footpaths: dict = field(default_factory=dict)  # name: Connection
 
 
-class PidGtfs:
-    def __init__(self):
-        self._results: dict = {}
-        self._trips: list = []
-
-    def calculate(self, start_hour: int = 0, stop_hour: int = 48, trip_frequency_min: int = 1,
-                  input_stops: str = "gtfs/stops.txt", input_stop_times: str = "gtfs/stop_times.txt"):
-        print(f"Load all stop IDs from {input_stops}")
-        stop_ids = self._parse_stop_ids(input_stops)
-
-        print(f"Load all trips between stops from {input_stop_times}")
-        trips = self._parse_trips(input_stop_times, start_hour, stop_hour)
+@dataclass
+class BuildState:
+    """
+    What the last build was made of, so a new feed can be applied as a diff.
+    Trips are the raw trips in the time period by GTFS trip_id,
+    groups are the trips with the same stops (as in _process_trips) and
+    edges are the connection sums of the groups with enough frequency.
+    """
+    start_hour: int
+    stop_hour: int
+    trip_frequency_min: int
+    footpath_radius_m: float = 0.0
+    stop_ids: dict = field(default_factory=dict)  # stop_id: (name, lat, lon)
+    trips: dict = field(default_factory=dict)  # trip_id: (signature, distances km, distances min)
+    groups: dict = field(default_factory=dict)  # signature: [count, distance_km sums, distance_min sums]
+    edges: dict = field(default_factory=dict)  # (stop_id_from, stop_id_to): [count, distance_km sum, distance_min sum]
 
-        print(f"Process trips")
-        trips = self._process_trips(trips, trip_frequency_min)
 
-        print("Complete trip stops with names")
-        for trip in trips.values():
-            for trip_stop in trip.trip_stops:
-                trip_stop.name_to = stop_ids[trip_stop.stop_id_to].name
-                trip_stop.name_from = stop_ids[trip_stop.stop_id_from].name
+@dataclass
+class HourlyBuckets:
+    """
+    All trips of the feed from one scan of stop_times.txt, bucketed by the hour of their first departure,
+    so a network of any time period is composed from the buckets of its hours (see PidGtfs.compose).
+    Groups are the trips of the hour with the same stops, with the position of their first trip in the feed,
+    so the composed groups keep the feed order. Footpaths are found once between all stops of the trips.
+    """
+    footpath_radius_m: float = 0.0
+    stop_ids: dict = field(default_factory=dict)  # stop_id: (name, lat, lon)
+    trips: dict = field(default_factory=dict)  # hour: {trip_id: (signature, distances km, distances min)}
+    groups: dict = field(default_factory=dict)  # hour: {signature: [count, distance_km sums, distance_min sums, first position]}
+    footpaths: dict = field(default_factory=dict)  # (name from, name to): Connection
 
-        print("Fill stop IDs with connections, this can take some time")
-        self._fill_stop_ids(stop_ids, trips)
 
-        print("Prepare final Stop classes from stop IDs")
-        stops = self._prepare_stops(stop_ids)
+class PidGtfs:
+    def __init__(self, instrumentation: Instrumentation = None):
+        self._results: dict = {}
+        self._trips: list = []
+        self._state: BuildState = None
+        self._buckets: HourlyBuckets = None
+        self._instrumentation = instrumentation if instrumentation is not None else Instrumentation()
 
-        print("Parse the relevant results to JSON")
-        self._to_result_json(stops, trips)
+    def calculate(self, start_hour: int = 0, stop_hour: int = 48, trip_frequency_min: int = 1,
+                  input_stops: str = "gtfs/stops.txt", input_stop_times: str = "gtfs/stop_times.txt", footpath_radius_m: float = 250.0,
+                  input_transfers: str = "gtfs/transfers.txt", input_pathways: str = "gtfs/pathways.txt"):
+        """
+        Connections between stops from the trips starting in the time period
+        and driving at least trip_frequency_min times, plus the footpaths between
+        the stops from the GTFS transfers and pathways and to all stops in footpath_radius_m.
+        """
+        with self._instrumentation.phase("calculate") as calculation:
+            with self._instrumentation.phase("parse_stop_ids", f"Load all stop IDs from {input_stops}") as phase:
+                stop_ids = self._parse_stop_ids(input_stops)
+                phase.summary = f"{len(stop_ids)} stop IDs"
+
+            with self._instrumentation.phase("parse_trips", f"Load all trips between stops from {input_stop_times}") as phase:
+                trips = self._parse_trips(input_stop_times, start_hour, stop_hour)
+                phase.summary = f"{len(trips)} trips"
+
+            with self._instrumentation.phase("record_state", "Record build state for incremental updates") as phase:
+                self._state = BuildState(start_hour=start_hour, stop_hour=stop_hour, trip_frequency_min=trip_frequency_min,
+                                         footpath_radius_m=footpath_radius_m,
+                                         stop_ids={id: (stop_id.name, stop_id.lat, stop_id.lon) for (id, stop_id) in stop_ids.items()})
+                for trip in trips.values():
+                    self._state.trips[trip.id] = self._to_trip_entry(trip)
+                    self._apply_trip_entry(self._state.trips[trip.id], 1)
+                phase.summary = f"{len(self._state.groups)} trip groups"
+
+            with self._instrumentation.phase("process_trips", "Process trips") as phase:
+                trips = self._process_trips(trips, trip_frequency_min)
+                phase.summary = f"{len(trips)} unique trips"
+
+            with self._instrumentation.phase("name_trip_stops", "Complete trip stops with names"):
+                for trip in trips.values():
+                    for trip_stop in trip.trip_stops:
+                        trip_stop.name_to = stop_ids[trip_stop.stop_id_to].name
+                        trip_stop.name_from = stop_ids[trip_stop.stop_id_from].name
+
+            with self._instrumentation.phase("fill_stop_ids", "Fill stop IDs with connections") as phase:
+                connection_count = self._fill_stop_ids(stop_ids, trips)
+                phase.summary = f"{connection_count} connections"
+
+            with self._instrumentation.phase("prepare_stops", "Prepare final Stop classes from stop IDs") as phase:
+                stops = self._prepare_stops(stop_ids)
+                phase.summary = f"{len(stops)} stops"
+
+            with self._instrumentation.phase("add_footpaths", "Add footpaths between close stops") as phase:
+                footpath_count = self._add_footpaths(stops, stop_ids, footpath_radius_m, input_transfers, input_pathways)
+                phase.summary = f"{footpath_count} footpaths"
+
+            with self._instrumentation.phase("to_result_json", "Parse the relevant results to JSON") as phase:
+                self._to_result_json(stops, trips)
+                phase.summary = f"{len(self._trips)} trips kept"
+
+        print(f"Calculation done in {calculation.wall_s:.2f} s")
+
+    def can_update(self, start_hour: int, stop_hour: int, trip_frequency_min: int, footpath_radius_m: float = 250.0) -> bool:
+        """
+        True if there is a previous build with the same parameters to update.
+        """
+        state = self._state
+        return state is not None and ((state.start_hour, state.stop_hour, state.trip_frequency_min, state.footpath_radius_m) ==
+                                      (start_hour, stop_hour, trip_frequency_min, footpath_radius_m))
+
+    def update(self, input_stops: str = "gtfs/stops.txt", input_stop_times: str = "gtfs/stop_times.txt",
+               input_transfers: str = "gtfs/transfers.txt", input_pathways: str = "gtfs/pathways.txt"):
+        """
+        Incremental rebuild from a new feed with the parameters of the previous build.
+        The new feed is diffed against the previous one by trip and stop,
+        only the changed trips are removed from and added to the trip groups
+        and connection sums. The results are then prepared from the sums,
+        the footpaths are found again.
+        """
+        if self._state is None:
+            raise Exception("No previous build to update, calculate or load the build state first")
+
+        state = self._state
+        with self._instrumentation.phase("update") as update:
+            with self._instrumentation.phase("parse_stop_ids", f"Load all stop IDs from {input_stops}") as phase:
+                stop_ids = self._parse_stop_ids(input_stops)
+                stop_entries = {id: (stop_id.name, stop_id.lat, stop_id.lon) for (id, stop_id) in stop_ids.items()}
+                changed_stops = sum(1 for (id, entry) in stop_entries.items() if state.stop_ids.get(id) != entry)
+                changed_stops += sum(1 for id in state.stop_ids if id not in stop_entries)
+                state.stop_ids = stop_entries
+                phase.count("stops_changed", changed_stops)
+                phase.summary = f"{len(stop_ids)} stop IDs, {changed_stops} changed"
+
+            with self._instrumentation.phase("parse_trips", f"Load all trips between stops from {input_stop_times}") as phase:
+                trips = self._parse_trips(input_stop_times, state.start_hour, state.stop_hour)
+                trip_entries = {trip.id: self._to_trip_entry(trip) for trip in trips.values()}
+                phase.summary = f"{len(trips)} trips"
+
+            with self._instrumentation.phase("apply_trips", "Apply changed trips") as phase:
+                old_entries = state.trips
+                removed = [id for id in old_entries if trip_entries.get(id) != old_entries[id]]
+                added = [id for id in trip_entries if old_entries.get(id) != trip_entries[id]]
+                for id in removed:
+                    self._apply_trip_entry(old_entries[id], -1)
+                for id in added:
+                    self._apply_trip_entry(trip_entries[id], 1)
+                state.trips = trip_entries
+                phase.count("trips_removed", len(removed))
+                phase.count("trips_added", len(added))
+                phase.summary = f"{len(removed)} trips removed, {len(added)} added"
+
+            with self._instrumentation.phase("results_from_state", "Prepare results from the connection sums") as phase:
+                self._results_from_state(stop_ids, input_transfers, input_pathways)
+                phase.summary = f"{len(self._results)} stops, {len(self._trips)} trips kept"
+
+        print(f"Update done in {update.wall_s:.2f} s")
+
+    def calculate_buckets(self, input_stops: str = "gtfs/stops.txt", input_stop_times: str = "gtfs/stop_times.txt", footpath_radius_m: float = 250.0,
+                          input_transfers: str = "gtfs/transfers.txt", input_pathways: str = "gtfs/pathways.txt"):
+        """
+        Hourly buckets of all the trips in one pass over the feed, networks are then composed from them.
+        """
+        with self._instrumentation.phase("calculate_buckets") as calculation:
+            with self._instrumentation.phase("parse_stop_ids", f"Load all stop IDs from {input_stops}") as phase:
+                stop_ids = self._parse_stop_ids(input_stops)
+                phase.summary = f"{len(stop_ids)} stop IDs"
+
+            with self._instrumentation.phase("parse_trips", f"Load all trips between stops from {input_stop_times}") as phase:
+                trips = self._parse_trips(input_stop_times, 0, 48)
+                phase.summary = f"{len(trips)} trips"
+
+            with self._instrumentation.phase("bucket_trips", "Bucket trips by the hour of their first departure") as phase:
+                buckets = HourlyBuckets(footpath_radius_m=footpath_radius_m,
+                                        stop_ids={id: (stop_id.name, stop_id.lat, stop_id.lon) for (id, stop_id) in stop_ids.items()})
+                for (position, trip) in enumerate(trips.values()):
+                    entry = self._to_trip_entry(trip)
+                    (signature, distances_km, distances_min) = entry
+                    buckets.trips.setdefault(trip.hour, {})[trip.id] = entry
+
+                    groups = buckets.groups.setdefault(trip.hour, {})
+                    group = groups.get(signature)
+                    if group is None:
+                        groups[signature] = [1, list(distances_km), list(distances_min), position]
+                    else:
+                        group[0] += 1
+                        for i in range(len(signature)):
+                            group[1][i] += distances_km[i]
+                            group[2][i] += distances_min[i]
+                phase.count("group_buckets", sum(len(groups) for groups in buckets.groups.values()))
+                phase.summary = f"{len(buckets.trips)} hours, {phase.counters['group_buckets']} trip groups"
+
+            with self._instrumentation.phase("find_footpaths", "Find footpaths between the stops of all trips") as phase:
+                names = {stop_ids[stop_id].name for groups in buckets.groups.values() for signature in groups
+                         for key in signature for stop_id in key}
+                buckets.footpaths = self._find_footpaths(stop_ids, names, footpath_radius_m, input_transfers, input_pathways)
+                phase.count("footpaths", len(buckets.footpaths))
+                phase.summary = f"{len(buckets.footpaths)} footpaths"
+
+        self._buckets = buckets
+        print(f"Bucketing done in {calculation.wall_s:.2f} s")
+
+    def compose(self, start_hour: int, stop_hour: int, trip_frequency_min: int):
+        """
+        Network of the trips starting in the time period and driving at least trip_frequency_min times
+        composed from the hourly buckets, the same as calculate, without reading the feed again.
+        The build state is composed too, so the network can be updated from a new feed.
+        """
+        if self._buckets is None:
+            raise Exception("No hourly buckets to compose from, calculate or load them first")
+
+        buckets = self._buckets
+        with self._instrumentation.phase("compose", f"Compose network of hours {start_hour}-{stop_hour} from the hourly buckets") as phase:
+            self._state = BuildState(start_hour=start_hour, stop_hour=stop_hour, trip_frequency_min=trip_frequency_min,
+                                     footpath_radius_m=buckets.footpath_radius_m, stop_ids=dict(buckets.stop_ids))
+            groups = {}
+            for hour in range(start_hour, stop_hour + 1):
+                self._state.trips.update(buckets.trips.get(hour, {}))
+                for (signature, (count, sums_km, sums_min, position)) in buckets.groups.get(hour, {}).items():
+                    group = groups.get(signature)
+                    if group is None:
+                        groups[signature] = [count, list(sums_km), list(sums_min), position]
+                    else:
+                        group[0] += count
+                        for i in range(len(signature)):
+                            group[1][i] += sums_km[i]
+                            group[2][i] += sums_min[i]
+                        group[3] = min(group[3], position)
+
+            # Groups and edges in the order of the first trip in the feed, as calculate has them
+            for (signature, group) in sorted(groups.items(), key=lambda item: item[1][3]):
+                self._state.groups[signature] = group[:3]
+                if group[0] >= trip_frequency_min:
+                    self._apply_group_edges(signature, self._state.groups[signature], 1)
+
+            stop_ids = {id: StopId(id=id, name=name, lat=lat, lon=lon) for (id, (name, lat, lon)) in buckets.stop_ids.items()}
+            self._results_from_state(stop_ids, footpaths=buckets.footpaths)
+            phase.summary = f"{len(self._state.trips)} trips, {len(self._results)} stops, {len(self._trips)} trips kept"
+
+    def save_buckets(self, buckets_file: str, key: bytes):
+        """
+        Save the hourly buckets for the feed version key (see network_cache.network_key).
+        """
+        temporary_file = buckets_file + ".tmp"
+        with open(temporary_file, "wb") as f:
+            pickle.dump((key, self._buckets), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_file, buckets_file)
+
+    def load_buckets(self, buckets_file: str, key: bytes) -> bool:
+        """
+        Load the hourly buckets saved for the feed version key, False if the file is missing or stale.
+        """
+        try:
+            with open(buckets_file, "rb") as f:
+                (file_key, buckets) = pickle.load(f)
+        except FileNotFoundError:
+            return False
+
+        if file_key != key:
+            return False
+
+        self._buckets = buckets
+        return True
+
+    def save_state(self, state_file: str = "output/build_state.pickle"):
+        with open(state_file, "wb") as f:
+            pickle.dump(self._state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_state(self, state_file: str = "output/build_state.pickle"):
+        with open(state_file, "rb") as f:
+            self._state = pickle.load(f)
+
+    def calculate_timetable(self, start_hour: int = 0, stop_hour: int = 48,
+                            input_stops: str = "gtfs/stops.txt", input_stop_times: str = "gtfs/stop_times.txt", footpath_radius_m: float = 250.0,
+                            input_transfers: str = "gtfs/transfers.txt", input_pathways: str = "gtfs/pathways.txt") -> Timetable:
+        """
+        Timetable with real departure times of the trips starting in the time period,
+        for time dependent routing. The stops are merged by name as in the results,
+        the footpaths are found the same way as in calculate.
+        """
+        with self._instrumentation.phase("parse_stop_ids", f"Load all stop IDs from {input_stops}") as phase:
+            stop_ids = self._parse_stop_ids(input_stops)
+            phase.summary = f"{len(stop_ids)} stop IDs"
+
+        with self._instrumentation.phase("read_stop_times", f"Load all stop times from {input_stop_times}") as phase:
+            stop_times = read_stop_times(input_stop_times, start_hour, stop_hour)
+            phase.count("rows_parsed", stop_times.scanned_rows)
+            phase.count("rows_kept", len(stop_times))
+            phase.summary = f"{len(stop_times)} stop times"
+
+        with self._instrumentation.phase("find_footpaths", "Find footpaths between close stops") as phase:
+            names = {stop_ids[stop_id].name for stop_id in stop_times.stop_ids}
+            footpaths = self._find_footpaths(stop_ids, names, footpath_radius_m, input_transfers, input_pathways)
+            phase.count("footpaths", len(footpaths))
+            phase.summary = f"{len(footpaths)} footpaths"
+
+        with self._instrumentation.phase("sort_timetable", "Sort timetable connections") as phase:
+            timetable = Timetable.from_stop_times(stop_times, {id: stop_id.name for (id, stop_id) in stop_ids.items()},
+                                                  {key: footpath.distance_min for (key, footpath) in footpaths.items()})
+            phase.count("connections", timetable.get_connection_count())
+            phase.summary = f"{timetable.get_connection_count()} connections"
+
+        return timetable
 
     def get_results(self) -> dict:
         return self._results
@@ -130,6 +405,73 @@ class PidGtfs:
         with open(trips_json, encoding="utf8") as f:
             self._trips = json.load(f)
 
+    def _to_trip_entry(self, trip: Trip) -> tuple:
+        return (tuple((trip_stop.stop_id_from, trip_stop.stop_id_to) for trip_stop in trip.trip_stops),
+                tuple(trip_stop.distance_km for trip_stop in trip.trip_stops),
+                tuple(trip_stop.distance_min for trip_stop in trip.trip_stops))
+
+    def _apply_trip_entry(self, entry: tuple, sign: int):
+        """
+        Add (sign 1) or remove (sign -1) one trip from its group in the build state.
+        The group contribution to the edges is removed and added back with the new sums.
+        """
+        state = self._state
+        (signature, distances_km, distances_min) = entry
+
+        group = state.groups.get(signature)
+        if group is None:
+            group = state.groups[signature] = [0, [0.0] * len(signature), [0.0] * len(signature)]
+        elif group[0] >= state.trip_frequency_min:
+            self._apply_group_edges(signature, group, -1)
+
+        group[0] += sign
+        for i in range(len(signature)):
+            group[1][i] += sign * distances_km[i]
+            group[2][i] += sign * distances_min[i]
+
+        if group[0] <= 0:
+            del state.groups[signature]
+        elif group[0] >= state.trip_frequency_min:
+            self._apply_group_edges(signature, group, 1)
+
+    def _apply_group_edges(self, signature: tuple, group: list, sign: int):
+        edges = self._state.edges
+        for (i, key) in enumerate(signature):
+            edge = edges.get(key)
+            if edge is None:
+                edge = edges[key] = [0, 0.0, 0.0]
+            edge[0] += sign * group[0]
+            edge[1] += sign * group[1][i]
+            edge[2] += sign * group[2][i]
+            if edge[0] <= 0:
+                del edges[key]
+
+    def _results_from_state(self, stop_ids: dict, input_transfers: str = None, input_pathways: str = None, footpaths: dict = None):
+        """
+        Results from the build state sums, the same as the calculate phases after the trip parsing.
+        With footpaths (e.g. of the hourly buckets) they are not found again, see _add_footpaths.
+        """
+        state = self._state
+        for ((stop_id_from, stop_id_to), (count, sum_km, sum_min)) in state.edges.items():
+            stop_ids[stop_id_from].connections[stop_id_to] = Connection(stop_id=stop_id_to, stop_name=stop_ids[stop_id_to].name,
+                                                                       distance_km=sum_km / count, distance_min=sum_min / count)
+
+        trips = {}
+        for (signature, (count, sums_km, sums_min)) in state.groups.items():
+            if count < state.trip_frequency_min:
+                continue
+
+            trip = Trip(id=str(len(trips)), frequency=count)
+            for (i, (stop_id_from, stop_id_to)) in enumerate(signature):
+                trip.trip_stops.append(TripStop(stop_id_from=stop_id_from, stop_id_to=stop_id_to,
+                                                distance_km=sums_km[i] / count, distance_min=sums_min[i] / count,
+                                                name_from=stop_ids[stop_id_from].name, name_to=stop_ids[stop_id_to].name))
+            trips[trip.id] = trip
+
+        stops = self._prepare_stops(stop_ids)
+        self._add_footpaths(stops, stop_ids, state.footpath_radius_m, input_transfers, input_pathways, footpaths)
+        self._to_result_json(stops, trips)
+
     def _parse_stop_ids(self, input_stops: str) -> dict:
         with open(input_stops, encoding="utf8") as f:
             csv_reared = csv.reader(f, delimiter=',', quotechar='"')
@@ -150,103 +492,96 @@ class PidGtfs:
         return stop_ids
 
     def _parse_trips(self, input_stop_times: str, start_hour: int, stop_hour: int) -> dict:
-        with open(input_stop_times, encoding="utf8") as f:
-            line = f.readline()
-            line = line.strip()
-            columns = line.split(",")
-            if len(columns) != 9 or columns[0] != "trip_id" or columns[-1] != "shape_dist_traveled":
-                raise Exception(f"Wrong file content: {columns}")
-
-            trips = {}
-            last_stop_id = None
-            last_departure_time = None
-            last_traveled = None
-            id_ignore = None
-
-            for line in f:
-                line = line.strip()
-                columns = line.split(",")
-
-                id = columns[0]
-                #arrival_time = columns[1]
-                departure_time = columns[2]
-                stop_id = columns[3]
-                traveled = columns[-1]
-
-                if id_ignore != id:
-                    if not id in trips:
-                        # Prepare new trip, if is in the time period
-                        (h, m, s) = departure_time.split(":")
-                        if start_hour <= int(h) <= stop_hour:
-                            trips[id] = Trip(id=id)
-                        else:
-                            id_ignore = id
-                    
-                    else:
-                        # Append each stop to existing trip
-                        distance_km = float(traveled) - float(last_traveled)
-                        (h, m, s) = departure_time.split(":")
-                        t_1 = float(h) * 60 + float(m) + float(s) / 60
-                        (h, m, s) = last_departure_time.split(":")
-                        t_2 = float(h) * 60 + float(m) + float(s) / 60
-                        distance_min = t_1 - t_2
-                        trips[id].trip_stops.append(TripStop(stop_id_from=last_stop_id, stop_id_to=stop_id, distance_km=distance_km, distance_min=distance_min))
-
-                last_stop_id = stop_id
-                last_departure_time = departure_time
-                last_traveled = traveled
+        stop_times = read_stop_times(input_stop_times, start_hour, stop_hour)
+        self._instrumentation.count("rows_parsed", stop_times.scanned_rows)
+        self._instrumentation.count("rows_kept", len(stop_times))
+
+        trip_ids = stop_times.trip_ids
+        stop_ids = stop_times.stop_ids
+
+        trips = {trip_id: Trip(id=trip_id) for trip_id in trip_ids}
+        rows = zip(stop_times.trips, stop_times.stops, stop_times.departures, stop_times.traveled)
+        (last_trip, last_stop, last_departure, last_traveled) = (-1, -1, 0, 0.0)
+        for (trip, stop, departure, traveled) in rows:
+            if trip == last_trip:
+                # Append each stop to existing trip
+                trips[trip_ids[trip]].trip_stops.append(TripStop(stop_id_from=stop_ids[last_stop], stop_id_to=stop_ids[stop],
+                                                                 distance_km=traveled - last_traveled,
+                                                                 distance_min=(departure - last_departure) / 60))
+            else:
+                trips[trip_ids[trip]].hour = departure // 3600
+            (last_trip, last_stop, last_departure, last_traveled) = (trip, stop, departure, traveled)
 
         return trips
 
     def _process_trips(self, trips: dict, trip_frequency_min: int) -> dict:
-        """There are a lot of trips with the same stops -> eliminate them and count the frequency"""
-        trips_new = {}
+        """
+        There are a lot of trips with the same stops -> eliminate them and count the frequency.
+        Trips are grouped in one pass by their stop sequence, the distances are the mean of the group.
+        """
+        groups = {}  # (stop_id_from, stop_id_to) sequence: (Trip, [distance_km sums], [distance_min sums])
 
         for trip in trips.values():
-            for trip_new in trips_new.values():
-                if trip.trip_stops == trip_new.trip_stops:
-                    # If equal, join the two
-                    average_trip_stops = []
-                    for i in range(len(trip.trip_stops)):
-                        average_trip_stops.append(TripStop(stop_id_from=trip.trip_stops[i].stop_id_from, stop_id_to=trip.trip_stops[i].stop_id_to, 
-                                                           distance_km=(trip.trip_stops[i].distance_km + trip_new.trip_stops[i].distance_km) / 2, 
-                                                           distance_min=(trip.trip_stops[i].distance_min + trip_new.trip_stops[i].distance_min) / 2))
-                    trip_new.trip_stops = average_trip_stops
-                    trip_new.frequency += 1
-                    break
+            signature = tuple((trip_stop.stop_id_from, trip_stop.stop_id_to) for trip_stop in trip.trip_stops)
+            group = groups.get(signature)
+            if group is None:
+                # If the trip was not found, it represents the new group
+                groups[signature] = (trip, [trip_stop.distance_km for trip_stop in trip.trip_stops],
+                                     [trip_stop.distance_min for trip_stop in trip.trip_stops])
             else:
-                # If the trip was not found, add it to the new list
-                trips_new[trip.id] = trip
+                (trip_new, sums_km, sums_min) = group
+                for (i, trip_stop) in enumerate(trip.trip_stops):
+                    sums_km[i] += trip_stop.distance_km
+                    sums_min[i] += trip_stop.distance_min
+                trip_new.frequency += 1
 
         trips_new_filtered = {}
-        for key, trip in trips_new.items():
+        for (trip, sums_km, sums_min) in groups.values():
             if trip.frequency >= trip_frequency_min:
-                trips_new_filtered[key] = trip
+                trip.trip_stops = [TripStop(stop_id_from=trip_stop.stop_id_from, stop_id_to=trip_stop.stop_id_to,
+                                            distance_km=sums_km[i] / trip.frequency, distance_min=sums_min[i] / trip.frequency)
+                                   for (i, trip_stop) in enumerate(trip.trip_stops)]
+                trips_new_filtered[trip.id] = trip
 
+        self._instrumentation.count("trips_merged", len(trips) - len(groups))
+        self._instrumentation.count("trip_groups_filtered", len(groups) - len(trips_new_filtered))
         return trips_new_filtered
 
-    def _fill_stop_ids(self, stop_ids: dict, trips: dict):
+    def _fill_stop_ids(self, stop_ids: dict, trips: dict) -> int:
+        """
+        Walk all trip stops once and aggregate them into connections between stop IDs.
+        The distance is the mean over every trip driving the connection, weighted by the trip frequency.
+        Returns the number of connections.
+        """
         progress_step = 10.0
         progress_next = progress_step
-        length = len(stop_ids)
+        length = len(trips)
         counter = 0
 
-        for stop_id in stop_ids.values():
-            for trip in trips.values():
-                for trip_stop in trip.trip_stops:
-                    if trip_stop.stop_id_from == stop_id.id:
-                        if not trip_stop.stop_id_to in stop_id.connections:
-                            stop_id.connections[trip_stop.stop_id_to] = Connection(stop_id=trip_stop.stop_id_to, stop_name=stop_ids[trip_stop.stop_id_to].name,
-                                                                                   distance_km=trip_stop.distance_km, distance_min=trip_stop.distance_min)
-                        else:
-                            stop_id.connections[trip_stop.stop_id_to].distance_km = (stop_id.connections[trip_stop.stop_id_to].distance_km + trip_stop.distance_km) / 2
-                            stop_id.connections[trip_stop.stop_id_to].distance_min = (stop_id.connections[trip_stop.stop_id_to].distance_min + trip_stop.distance_min) / 2
+        aggregates = {}  # (stop_id_from, stop_id_to): [count, distance_km sum, distance_min sum]
+        for trip in trips.values():
+            for trip_stop in trip.trip_stops:
+                key = (trip_stop.stop_id_from, trip_stop.stop_id_to)
+                aggregate = aggregates.get(key)
+                if aggregate is None:
+                    aggregates[key] = [trip.frequency, trip_stop.distance_km * trip.frequency, trip_stop.distance_min * trip.frequency]
+                else:
+                    aggregate[0] += trip.frequency
+                    aggregate[1] += trip_stop.distance_km * trip.frequency
+                    aggregate[2] += trip_stop.distance_min * trip.frequency
 
             counter += 1
             if (counter / length) * 100.0 >= progress_next:
                 print(f"    - {progress_next}%")
                 progress_next += progress_step
 
+        for ((stop_id_from, stop_id_to), (count, sum_km, sum_min)) in aggregates.items():
+            stop_ids[stop_id_from].connections[stop_id_to] = Connection(stop_id=stop_id_to, stop_name=stop_ids[stop_id_to].name,
+                                                                       distance_km=sum_km / count, distance_min=sum_min / count)
+
+        self._instrumentation.count("edges", len(aggregates))
+        return len(aggregates)
+
     def _prepare_stops(self, stop_ids: dict) -> dict:
         stops = {}
         for stop_id in stop_ids.values():
@@ -265,35 +600,131 @@ class PidGtfs:
 
         return stops
 
+    def _add_footpaths(self, stops: dict, stop_ids: dict, radius_m: float, input_transfers: str, input_pathways: str,
+                       all_footpaths: dict = None) -> int:
+        """
+        Fill the footpaths of the stops in the network (with connections or reachable by them).
+        With all_footpaths (found for more stops) only the ones between the network stops are kept,
+        which is the same as finding them for the network stops.
+        Returns the number of footpaths.
+        """
+        names = set()
+        for stop in stops.values():
+            if stop.connections:
+                names.add(stop.name)
+                names.update(stop.connections)
+
+        if all_footpaths is None:
+            footpaths = self._find_footpaths(stop_ids, names, radius_m, input_transfers, input_pathways)
+        else:
+            footpaths = {key: footpath for (key, footpath) in all_footpaths.items() if key[0] in names and key[1] in names}
+        for ((name_from, name_to), footpath) in footpaths.items():
+            stops[name_from].footpaths[name_to] = footpath
+
+        self._instrumentation.count("footpaths", len(footpaths))
+        return len(footpaths)
+
+    def _find_footpaths(self, stop_ids: dict, names: set, radius_m: float, input_transfers: str, input_pathways: str) -> dict:
+        """
+        Walking connections between the differently named stops of the names set.
+        They are the GTFS transfers and pathways (if the files exist) with their times,
+        and all the stop IDs in radius_m, found by a spatial index, at walking speed.
+        The fastest one is kept for each pair of names.
+        Returns dictionary (name from, name to): Connection.
+        """
+        footpaths = {}
+
+        def add(stop_id_from: str, stop_id_to: str, meters: float, minutes: float):
+            stop_from = stop_ids[stop_id_from]
+            stop_to = stop_ids[stop_id_to]
+            if stop_from.name == stop_to.name or stop_from.name not in names or stop_to.name not in names:
+                return
+
+            key = (stop_from.name, stop_to.name)
+            if key not in footpaths or minutes < footpaths[key].distance_min:
+                footpaths[key] = Connection(stop_id=stop_id_to, stop_name=stop_to.name, distance_km=meters / 1000, distance_min=minutes)
+
+        def meters_between(stop_id_from: str, stop_id_to: str) -> float:
+            stop_to = stop_ids[stop_id_to]
+            return haversine_many((stop_ids[stop_id_from].lat, stop_ids[stop_id_from].lon), [stop_to.lat], [stop_to.lon])[0]
+
+        if os.path.exists(input_transfers):
+            with open(input_transfers, encoding="utf-8-sig") as f:
+                for row in csv.DictReader(f):
+                    if row["transfer_type"] not in ("", "0", "1", "2") or row.get("from_trip_id") or row.get("to_trip_id"):
+                        continue  # Transfer not possible or only between specific trips
+                    if row["from_stop_id"] not in stop_ids or row["to_stop_id"] not in stop_ids:
+                        continue
+
+                    meters = meters_between(row["from_stop_id"], row["to_stop_id"])
+                    minutes = int(row["min_transfer_time"]) / 60 if row.get("min_transfer_time") else walking_minutes(meters)
+                    add(row["from_stop_id"], row["to_stop_id"], meters, minutes)
+
+        if os.path.exists(input_pathways):
+            with open(input_pathways, encoding="utf-8-sig") as f:
+                for row in csv.DictReader(f):
+                    if row["from_stop_id"] not in stop_ids or row["to_stop_id"] not in stop_ids:
+                        continue
+
+                    length = row.get("length") or row.get("Shape_Length")
+                    meters = float(length) if length else meters_between(row["from_stop_id"], row["to_stop_id"])
+                    minutes = int(row["traversal_time"]) / 60 if row.get("traversal_time") else walking_minutes(meters)
+                    add(row["from_stop_id"], row["to_stop_id"], meters, minutes)
+                    if row.get("is_bidirectional") == "1":
+                        add(row["to_stop_id"], row["from_stop_id"], meters, minutes)
+
+        if radius_m > 0:
+            ids = [stop_id for stop_id in stop_ids.values() if stop_id.name in names]
+            index = SpatialIndex([stop_id.lat for stop_id in ids], [stop_id.lon for stop_id in ids])
+            for stop_id in ids:
+                for (neighbour, meters) in index.within((stop_id.lat, stop_id.lon), radius_m):
+                    add(stop_id.id, ids[neighbour].id, meters, walking_minutes(meters))
+
+        return footpaths
+
     def _to_result_json(self, stops: dict, trips: dict):
         self._results = {}
         for stop in stops.values():
-            if len(stop.connections) > 0:
-                self._results[stop.name] = {"longitude": stop.lon, "latitude": stop.lat, "connections": {}}
+            if len(stop.connections) > 0 or len(stop.footpaths) > 0:
+                self._results[stop.name] = {"longitude": stop.lon, "latitude": stop.lat, "connections": {}, "footpaths": {}}
                 for connection in stop.connections.values():
                     self._results[stop.name]["connections"][connection.stop_name] = {"distance_km": connection.distance_km, "distance_min": connection.distance_min}
-
-        self._trips = []
-        for trip in trips.values():
-            one_trip = []
-            for trip_stop in trip.trip_stops:
-                one_trip.append(trip_stop.name_from)
-            one_trip.append(trip.trip_stops[-1].name_to)
-
-            # Lets eliminate duplicates and subsets
-            for final in self._trips:
-                final_set = set(final)
-                trip_set = set(one_trip)
-                if trip_set.issubset(final_set):
+                for footpath in stop.footpaths.values():
+                    self._results[stop.name]["footpaths"][footpath.stop_name] = {"distance_km": footpath.distance_km, "distance_min": footpath.distance_min}
+
+        self._trips = self._eliminate_subtrips([[trip_stop.name_from for trip_stop in trip.trip_stops] + [trip.trip_stops[-1].name_to]
+                                                for trip in trips.values() if trip.trip_stops])
+
+    def _eliminate_subtrips(self, all_trips: list) -> list:
+        """
+        Lets eliminate duplicates and subsets. A trip is dropped, if a kept trip
+        contains all its stops and drives from its first to its last stop in the same direction.
+        Trips are checked from the most stops, so the covering trips are kept first,
+        candidates are only the kept trips with the least common stop of the trip (inverted index).
+        Kept trips are returned in the input order.
+        """
+        trip_sets = [set(one_trip) for one_trip in all_trips]
+        order = sorted(range(len(all_trips)), key=lambda index: -len(trip_sets[index]))
+
+        kept = []
+        first_indexes = {}  # Kept trip index: {stop name: first index in the trip}
+        stop_index = {}  # Stop name: [kept trip indexes]
+        for index in order:
+            one_trip = all_trips[index]
+            trip_set = trip_sets[index]
+            candidates = min((stop_index.get(stop, ()) for stop in trip_set), key=len)
+            for final in candidates:
+                if trip_set <= trip_sets[final]:
                     # Check for the correct direction
-                    if final.index(one_trip[0]) < final.index(one_trip[-1]):
-                        break
-                elif trip_set.issuperset(final_set):
-                    if one_trip.index(final[0]) < one_trip.index(final[-1]):
-                        self._trips.remove(final)
-                        self._trips.append(one_trip)
+                    if first_indexes[final][one_trip[0]] < first_indexes[final][one_trip[-1]]:
                         break
-
             else:
-                self._trips.append(one_trip) 
-
+                kept.append(index)
+                first_indexes[index] = {}
+                for (position, stop) in enumerate(one_trip):
+                    first_indexes[index].setdefault(stop, position)
+                for stop in trip_set:
+                    stop_index.setdefault(stop, []).append(index)
+
+        self._instrumentation.count("trips_eliminated", len(all_trips) - len(kept))
+        return [all_trips[index] for index in sorted(kept)]
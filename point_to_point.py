@@ -0,0 +1,248 @@
+from array import array
+import heapq
+import math
+import mmap
+import os
+import struct
+
+from connections_graph import ConnectionsGraph
+from path_calculations import ConnectionsAccess
+
+
+# Binary landmarks layout (little endian, sections aligned to 8 bytes): header, landmark stop IDs (int32),
+# then distances from and to each landmark for all stops (float64)
+LANDMARKS_MAGIC = b"PIDALT\0\0"
+LANDMARKS_VERSION = 2
+_HEADER = struct.Struct("<8sI32sII")
+_ALIGNMENT = 8
+
+
+class Landmarks():
+    """
+    ALT (A*, landmarks, triangle inequality) lower bounds of the minutes between stops.
+    For each landmark there are the shortest minutes from it to all stops and from all
+    stops to it, so d(v, t) >= d(L, t) - d(L, v) and d(v, t) >= d(v, L) - d(t, L).
+    Landmarks are picked one by one as the stop farthest from the already picked ones.
+    """
+
+    def __init__(self, landmark_ids: array, from_landmarks: list, to_landmarks: list):
+        self.landmark_ids = landmark_ids
+        self.from_landmarks = from_landmarks  # array("d") of minutes from the landmark for each landmark
+        self.to_landmarks = to_landmarks  # array("d") of minutes to the landmark for each landmark
+
+    @classmethod
+    def from_graph(cls, graph: ConnectionsGraph, count: int = 16):
+        stop_count = graph.get_stop_count()
+        reverse = _reverse_graph(graph)
+
+        landmark_ids = array("l")
+        from_landmarks = []
+        to_landmarks = []
+        closest = array("d", [math.inf]) * stop_count  # Minutes from the closest picked landmark
+        from_first = _shortest_minutes(graph.offsets, graph.targets, graph.distances_min, 0, stop_count)
+        candidate = max(range(stop_count), key=lambda stop_id: from_first[stop_id] if from_first[stop_id] != math.inf else -1)
+        for _ in range(min(count, stop_count)):
+            landmark_ids.append(candidate)
+            from_landmarks.append(_shortest_minutes(graph.offsets, graph.targets, graph.distances_min, candidate, stop_count))
+            to_landmarks.append(_shortest_minutes(*reverse, candidate, stop_count))
+
+            closest = array("d", map(min, closest, from_landmarks[-1]))
+            reachable = [stop_id for stop_id in range(stop_count) if closest[stop_id] != math.inf and stop_id not in landmark_ids]
+            if not reachable:
+                break
+            candidate = max(reachable, key=closest.__getitem__)
+
+        return cls(landmark_ids, from_landmarks, to_landmarks)
+
+    def get_count(self) -> int:
+        return len(self.landmark_ids)
+
+    def lower_bound(self, stop_id: int, target_id: int, landmarks: list = None) -> float:
+        """
+        Lower bound of the minutes from the stop to the target, inf if the target is not reachable.
+        Bounds with unknown (inf) minutes of the stop are left out.
+        Only the given landmark indexes are used, all of them without it.
+        """
+        bound = 0.0
+        for landmark in (landmarks if landmarks is not None else range(self.get_count())):
+            from_landmark = self.from_landmarks[landmark]
+            to_landmark = self.to_landmarks[landmark]
+            if from_landmark[stop_id] != math.inf:
+                bound = max(bound, from_landmark[target_id] - from_landmark[stop_id])
+            if to_landmark[target_id] != math.inf:
+                bound = max(bound, to_landmark[stop_id] - to_landmark[target_id])
+
+        return bound
+
+    def get_active(self, start_id: int, target_id: int, count: int) -> list:
+        """
+        Indexes of the count landmarks with the best bounds between the start and target.
+        """
+        return heapq.nlargest(count, range(self.get_count()), key=lambda landmark: self.lower_bound(start_id, target_id, [landmark]))
+
+    def save(self, landmarks_file: str, key: bytes):
+        """
+        Save the landmarks for the network version key (see network_cache.network_key).
+        """
+        stop_count = len(self.from_landmarks[0]) if self.from_landmarks else 0
+        sections = [_HEADER.pack(LANDMARKS_MAGIC, LANDMARKS_VERSION, key, self.get_count(), stop_count),
+                    array("i", self.landmark_ids).tobytes()]
+        sections.extend(array("d", distances).tobytes() for distances in self.from_landmarks + self.to_landmarks)
+
+        temporary_file = landmarks_file + ".tmp"
+        with open(temporary_file, "wb") as f:
+            for section in sections:
+                f.write(section + b"\0" * (_aligned(len(section)) - len(section)))
+        os.replace(temporary_file, landmarks_file)
+
+    @classmethod
+    def load(cls, landmarks_file: str, key: bytes):
+        """
+        Map the landmarks saved for the network version key into memory without copying the arrays,
+        None if the file is missing, stale or of another version.
+        """
+        try:
+            with open(landmarks_file, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None  # Missing or empty file
+
+        if len(data) < _HEADER.size:
+            return None
+        (magic, version, file_key, count, stop_count) = _HEADER.unpack_from(data)
+        if magic != LANDMARKS_MAGIC or version != LANDMARKS_VERSION or file_key != key:
+            return None
+
+        view = memoryview(data)
+        position = _aligned(_HEADER.size)
+        landmark_ids = view[position:position + count * 4].cast("i")
+        position = _aligned(position + count * 4)
+        all_distances = []
+        for _ in range(2 * count):
+            all_distances.append(view[position:position + stop_count * 8].cast("d"))
+            position += stop_count * 8
+
+        return cls(landmark_ids, all_distances[:count], all_distances[count:])
+
+
+class PointToPointSearch():
+    """
+    Class finds the shortest path (in minutes) between two stops with A* search.
+    The ALT landmark bounds direct the search towards the target
+    and it stops, when the target is settled, so only a part of the network is searched.
+    Only the active landmarks (best bounds between the start and target) are used,
+    the bound of each stop is calculated once per search.
+    Without landmarks it is a plain Dijkstra search stopping at the target.
+    """
+
+    def __init__(self, connections: ConnectionsAccess, landmarks: Landmarks = None, active_count: int = 3):
+        self._graph = connections.get_graph()
+        self._landmarks = landmarks
+        self._active_count = active_count
+        self._settled_count = 0
+
+    def find_path(self, start_stop: str, target_stop: str):
+        """
+        Returns (Total Distance, [Path]) or None, if the target is not reachable.
+        """
+        graph = self._graph
+        start_id = graph.get_id(start_stop)
+        target_id = graph.get_id(target_stop)
+        bounds = {}  # Stop ID: lower bound to the target
+        if self._landmarks is not None:
+            active = self._landmarks.get_active(start_id, target_id, self._active_count)
+
+            def heuristic(stop_id: int) -> float:
+                bound = bounds.get(stop_id)
+                if bound is None:
+                    bound = bounds[stop_id] = self._landmarks.lower_bound(stop_id, target_id, active)
+                return bound
+        else:
+            def heuristic(stop_id: int) -> float:
+                return 0.0
+
+        distances = {start_id: 0.0}
+        predecessors = {start_id: -1}
+        settled = set()
+        queue = [(heuristic(start_id), start_id)]
+        self._settled_count = 0
+
+        while queue:
+            (_, stop_id) = heapq.heappop(queue)
+            if stop_id in settled:
+                continue
+            settled.add(stop_id)
+            self._settled_count += 1
+
+            if stop_id == target_id:
+                path = []
+                while stop_id != -1:
+                    path.append(graph.names[stop_id])
+                    stop_id = predecessors[stop_id]
+                return (round(distances[target_id], 1), path[::-1])
+
+            distance = distances[stop_id]
+            for edge in graph.get_connections(stop_id):
+                target = graph.targets[edge]
+                new_distance = distance + graph.distances_min[edge]
+                if target not in settled and new_distance < distances.get(target, math.inf):
+                    estimate = new_distance + heuristic(target)
+                    if estimate != math.inf:
+                        distances[target] = new_distance
+                        predecessors[target] = stop_id
+                        heapq.heappush(queue, (estimate, target))
+
+        return None
+
+    def get_settled_count(self) -> int:
+        """
+        Number of stops settled by the last search.
+        """
+        return self._settled_count
+
+
+def _reverse_graph(graph: ConnectionsGraph) -> tuple:
+    """
+    CSR (offsets, targets, distances_min) of the graph with reversed connections.
+    """
+    stop_count = graph.get_stop_count()
+    incoming = [[] for _ in range(stop_count)]
+    for stop_id in range(stop_count):
+        for edge in graph.get_connections(stop_id):
+            incoming[graph.targets[edge]].append((stop_id, graph.distances_min[edge]))
+
+    offsets = array("l", [0])
+    targets = array("l")
+    distances_min = array("d")
+    for edges in incoming:
+        for (source, minutes) in edges:
+            targets.append(source)
+            distances_min.append(minutes)
+        offsets.append(len(targets))
+
+    return (offsets, targets, distances_min)
+
+
+def _shortest_minutes(offsets, targets, distances_min, start_id: int, stop_count: int) -> array:
+    """
+    Dijkstra minutes from the start stop ID to all stop IDs over the CSR arrays.
+    """
+    distances = array("d", [math.inf]) * stop_count
+    distances[start_id] = 0.0
+    queue = [(0.0, start_id)]
+    while queue:
+        (distance, stop_id) = heapq.heappop(queue)
+        if distance > distances[stop_id]:
+            continue
+
+        for edge in range(offsets[stop_id], offsets[stop_id + 1]):
+            new_distance = distance + distances_min[edge]
+            if new_distance < distances[targets[edge]]:
+                distances[targets[edge]] = new_distance
+                heapq.heappush(queue, (new_distance, targets[edge]))
+
+    return distances
+
+
+def _aligned(position: int) -> int:
+    return (position + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
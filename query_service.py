@@ -0,0 +1,399 @@
+import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import json
+import math
+import multiprocessing
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from connections_graph import RidesGraph
+from meeting_point import SCORERS, MeetingPointSearch, score_matrix, top_k
+from network import PATH_CACHE_DIRECTORY, TRANSFER_MINUTES, TRAVEL_MATRIX_FILE, load_or_calculate_landmarks, load_or_calculate_network
+from path_cache import PathCache
+from path_calculations import ConnectionsAccess, TravelTimes, create_calculation, get_path
+from point_to_point import Landmarks, PointToPointSearch
+from travel_matrix import TravelMatrix
+
+
+# Shared read-only state of the worker processes, inherited on fork (copy-on-write)
+_worker_state = None
+
+
+def _calculate_origins(start_stops: list) -> list:
+    """
+    Worker function, calculates one batch of start stops.
+    """
+    (connections, rides, transfer_minutes) = _worker_state
+    all_results = []
+    for start_stop in start_stops:
+        all_results.append(create_calculation(connections, start_stop, rides, transfer_minutes).get_results())
+
+    return all_results
+
+
+def _find_meeting_points(start_stops: list, k: int, scorer: str) -> tuple:
+    """
+    Worker function, the early terminating meeting point search, returns (results, settled count).
+    """
+    (connections, _, _) = _worker_state
+    search = MeetingPointSearch(connections, start_stops, k, scorer)
+    search.find_meeting_points()
+
+    return (search.get_results(), search.get_settled_count())
+
+
+class QueryError(Exception):
+    """
+    Invalid query, reported to the client with the HTTP status.
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class LatencyMetrics():
+    """
+    Request count, errors and latency percentiles of the recent requests of one endpoint.
+    """
+
+    def __init__(self, window: int = 1000):
+        self._latencies = deque(maxlen=window)
+        self._count = 0
+        self._errors = 0
+
+    def add(self, seconds: float, error: bool):
+        self._latencies.append(seconds)
+        self._count += 1
+        self._errors += int(error)
+
+    def to_json(self) -> dict:
+        latencies = sorted(self._latencies)
+        if not latencies:
+            return {"count": self._count, "errors": self._errors}
+
+        def percentile(value: float) -> float:
+            return round(latencies[min(int(len(latencies) * value / 100), len(latencies) - 1)] * 1000, 3)
+
+        return {"count": self._count, "errors": self._errors,
+                "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+                "p50_ms": percentile(50), "p95_ms": percentile(95), "p99_ms": percentile(99),
+                "max_ms": round(latencies[-1] * 1000, 3)}
+
+
+class QueryService():
+    """
+    Long running query service with the network loaded once in memory.
+    The asyncio front end answers HTTP/JSON requests, the path searches run
+    in a pool of forked worker processes sharing the loaded graph.
+    Start stop searches requested within the batch window are sent to
+    the workers together, the same start stop is never searched twice
+    at once and the results are kept in the path cache.
+
+    Endpoints (GET query parameters or POST JSON body with the same names):
+      /travel-times?from=X             minutes and transfers from X to all stops
+      /path?from=X&to=Y                path from X to Y
+      /route?from=X&to=Y               fastest path in minutes from X to Y (A* search, no transfers)
+      /meeting-point?stops=A&stops=B   best meeting stops, optional k and scorer,
+                                       early=1 for the early terminating search by minutes only
+      /nearest?lat=X&lon=Y             closest stops with meters, optional k
+      /metrics                         per endpoint latency metrics
+
+    Start stops (from, stops) can also be GPS "latitude,longitude",
+    the search then starts by walking to the closest stops.
+    Meeting points of start stops in the travel matrix are looked up without searching.
+    """
+
+    def __init__(self, connections: ConnectionsAccess, rides: RidesGraph, transfer_minutes: float, cache: PathCache,
+                 processes: int = None, batch_window_ms: float = 2.0, batch_size: int = 8, landmarks: Landmarks = None,
+                 travel_matrix: TravelMatrix = None):
+        global _worker_state
+        self._connections = connections
+        self._graph = connections.get_graph()
+        self._rides = rides
+        self._transfer_minutes = transfer_minutes
+        self._cache = cache
+        self._mode = "minutes" if rides is None else f"transfers-{transfer_minutes}"
+        self._batch_window = batch_window_ms / 1000
+        self._batch_size = batch_size
+        self._point_to_point = PointToPointSearch(connections, landmarks)
+        self._travel_matrix = travel_matrix
+        if travel_matrix is not None and (rides is None or travel_matrix.transfer_minutes != transfer_minutes):
+            self._travel_matrix = None  # Calculated for another search mode
+
+        # Set before the pool forks its workers. The workers are started right away
+        # by an empty task, so they do not inherit the sockets of the running server.
+        _worker_state = (connections, rides, transfer_minutes)
+        self._executor = ProcessPoolExecutor(processes or multiprocessing.cpu_count(), mp_context=multiprocessing.get_context("fork"))
+        self._executor.submit(_calculate_origins, []).result()
+
+        self._running = {}  # Start stop: future of its results
+        self._pending = []  # Start stops waiting for the next batch
+        self._flush_handle = None
+        self._metrics = {}  # Endpoint: LatencyMetrics
+        self._endpoints = {
+            "/travel-times": self._travel_times_endpoint,
+            "/path": self._path_endpoint,
+            "/route": self._route_endpoint,
+            "/meeting-point": self._meeting_point_endpoint,
+            "/nearest": self._nearest_endpoint,
+            "/metrics": self._metrics_endpoint,
+        }
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080, unix_socket: str = None):
+        if unix_socket:
+            server = await asyncio.start_unix_server(self._handle_connection, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self._handle_connection, host, port)
+
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    async def get_results(self, start_stop) -> list:
+        """
+        Results of PathCalculations.get_results for the start stop (name or GPS tuple).
+        """
+        if isinstance(start_stop, str) and not self._graph.has_stop(start_stop):
+            raise QueryError(400, f"Unknown stop: {start_stop}")
+
+        results = self._cache.get(start_stop, self._mode)
+        if results is not None:
+            return results
+
+        future = self._running.get(start_stop)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._running[start_stop] = future
+            self._pending.append(start_stop)
+            if len(self._pending) >= self._batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self._batch_window, self._flush)
+
+        return await asyncio.shield(future)
+
+    async def query(self, endpoint: str, parameters: dict) -> dict:
+        """
+        Answer one query, the parameters are lists of values by name.
+        """
+        handler = self._endpoints.get(endpoint)
+        if handler is None:
+            raise QueryError(404, f"Unknown endpoint: {endpoint}")
+
+        start = time.perf_counter()
+        error = True
+        try:
+            response = await handler(parameters)
+            error = False
+            return response
+        finally:
+            self._metrics.setdefault(endpoint, LatencyMetrics()).add(time.perf_counter() - start, error)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        start_stops = self._pending
+        self._pending = []
+        if start_stops:
+            batch = asyncio.get_running_loop().run_in_executor(self._executor, _calculate_origins, start_stops)
+            batch.add_done_callback(lambda done: self._finish_batch(start_stops, done))
+
+    def _finish_batch(self, start_stops: list, batch: asyncio.Future):
+        # Every future of the batch is resolved first, a failed cache write only loses the cached results
+        for (index, start_stop) in enumerate(start_stops):
+            future = self._running.pop(start_stop)
+            if batch.cancelled():
+                future.cancel()
+            elif batch.exception() is not None:
+                future.set_exception(batch.exception())
+            else:
+                results = batch.result()[index]
+                future.set_result(results)
+                try:
+                    self._cache.put(start_stop, self._mode, results)
+                except Exception as e:
+                    print(f"Results of {start_stop} not cached: {type(e).__name__}: {e}")
+
+    async def _travel_times_endpoint(self, parameters: dict) -> dict:
+        start_stop = self._get_origin(self._get_parameter(parameters, "from"))
+        results = await self.get_results(start_stop)
+
+        return {"from": start_stop, "stops": {result[0]: self._to_json(result) for result in results}}
+
+    async def _path_endpoint(self, parameters: dict) -> dict:
+        start_stop = self._get_origin(self._get_parameter(parameters, "from"))
+        target_stop = self._get_parameter(parameters, "to")
+        if not self._graph.has_stop(target_stop):
+            raise QueryError(400, f"Unknown stop: {target_stop}")
+
+        results_by_stop = {result[0]: result for result in await self.get_results(start_stop)}
+        if target_stop in results_by_stop:
+            response = {"from": start_stop, "to": target_stop, "path": get_path(results_by_stop, target_stop)}
+            response.update(self._to_json(results_by_stop[target_stop]))
+            return response
+
+        raise QueryError(404, f"No path from {start_stop} to {target_stop}")
+
+    async def _route_endpoint(self, parameters: dict) -> dict:
+        start_stop = self._get_parameter(parameters, "from")
+        target_stop = self._get_parameter(parameters, "to")
+        for stop in (start_stop, target_stop):
+            if not self._graph.has_stop(stop):
+                raise QueryError(400, f"Unknown stop: {stop}")
+
+        # A short search, answered right in the event loop
+        result = self._point_to_point.find_path(start_stop, target_stop)
+        if result is None:
+            raise QueryError(404, f"No path from {start_stop} to {target_stop}")
+
+        return {"from": start_stop, "to": target_stop, "distance_min": result[0], "path": result[1],
+                "settled": self._point_to_point.get_settled_count()}
+
+    async def _meeting_point_endpoint(self, parameters: dict) -> dict:
+        start_stops = [self._get_origin(start_stop) for start_stop in parameters.get("stops", [])]
+        if not start_stops:
+            raise QueryError(400, "Missing parameter: stops")
+        k = int(parameters.get("k", [10])[0])
+        scorer = parameters.get("scorer", ["fair"])[0]
+        if scorer not in SCORERS:
+            raise QueryError(400, f"Unknown scorer: {scorer}")
+
+        if str(parameters.get("early", ["0"])[0]).lower() in ("1", "true"):
+            if k < 1:
+                raise QueryError(400, f"Parameter k must be at least 1, not {k}")
+            (results, settled_count) = await asyncio.get_running_loop().run_in_executor(
+                self._executor, _find_meeting_points, start_stops, k, scorer)
+            return {"stops": start_stops, "scorer": scorer, "early": True, "settled": settled_count,
+                    "meeting_points": [{"stop": stop, "score": score} for (stop, score) in results]}
+
+        matrix = self._travel_matrix
+        if matrix is not None and all(isinstance(start_stop, str) and matrix.has_origin(start_stop) for start_stop in start_stops):
+            travel_times = matrix.get_travel_times(start_stops)
+        else:
+            all_results = await asyncio.gather(*(self.get_results(start_stop) for start_stop in start_stops))
+            travel_times = TravelTimes.from_results(self._graph, start_stops, all_results, self._rides is not None)
+        scores = score_matrix(travel_times.minutes, travel_times.transfers, self._transfer_minutes, scorer)
+
+        return {"stops": start_stops, "scorer": scorer,
+                "meeting_points": [{"stop": travel_times.stops[index], "score": scores[index]} for index in top_k(scores, k)]}
+
+    async def _nearest_endpoint(self, parameters: dict) -> dict:
+        gps = (float(self._get_parameter(parameters, "lat")), float(self._get_parameter(parameters, "lon")))
+        k = int(parameters.get("k", [5])[0])
+        if k < 1:
+            raise QueryError(400, f"Parameter k must be at least 1, not {k}")
+
+        return {"lat": gps[0], "lon": gps[1],
+                "stops": [{"stop": name, "meters": round(meters, 1)} for (name, meters) in self._connections.get_nearest_stops(gps, k)]}
+
+    async def _metrics_endpoint(self, parameters: dict) -> dict:
+        return {endpoint: metrics.to_json() for (endpoint, metrics) in self._metrics.items()}
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                request_line = await reader.readline()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    (name, _, value) = line.decode("latin1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                (method, target, _) = request_line.decode("utf8").split(" ", 2)
+                url = urlsplit(target)
+                parameters = parse_qs(url.query)
+                if method == "POST":
+                    body = await reader.readexactly(int(headers.get("content-length", 0)))
+                    if body:
+                        data = json.loads(body)
+                        if not isinstance(data, dict):
+                            raise QueryError(400, "Request body must be a JSON object")
+                        for (name, value) in data.items():
+                            parameters[name] = value if isinstance(value, list) else [value]
+
+                (status, response) = (200, await self.query(url.path, parameters))
+            except QueryError as e:
+                (status, response) = (e.status, {"error": str(e)})
+            except (ValueError, json.JSONDecodeError, asyncio.IncompleteReadError) as e:
+                (status, response) = (400, {"error": f"Bad request: {e}"})
+            except Exception as e:
+                (status, response) = (500, {"error": f"Internal error: {type(e).__name__}: {e}"})
+
+            body = json.dumps(response, ensure_ascii=False).encode("utf8")
+            writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                         f"Content-Type: application/json; charset=utf-8\r\nContent-Length: {len(body)}\r\n"
+                         "Connection: close\r\n\r\n".encode("latin1") + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def _get_parameter(self, parameters: dict, name: str) -> str:
+        values = parameters.get(name)
+        if not values:
+            raise QueryError(400, f"Missing parameter: {name}")
+
+        return values[0]
+
+    def _get_origin(self, value: str):
+        """
+        Stop name, or GPS tuple for "latitude,longitude" not being a stop name.
+        """
+        if self._graph.has_stop(value):
+            return value
+
+        try:
+            (latitude, longitude) = map(float, value.split(","))
+        except ValueError:
+            raise QueryError(400, f"Unknown stop: {value}")
+
+        return (latitude, longitude)
+
+    def _to_json(self, result: list) -> dict:
+        minutes = result[1] if result[1] != math.inf else None
+        if self._rides is None:
+            return {"distance_min": minutes}
+
+        return {"distance_min": minutes, "transfers": result[2]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query service for paths between Prague stops")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix-socket", help="Listen on a Unix socket instead of TCP")
+    parser.add_argument("--processes", type=int, help="Number of search worker processes")
+    parser.add_argument("--transfer-minutes", type=float, default=TRANSFER_MINUTES)
+    arguments = parser.parse_args()
+
+    (graph, trips, key) = load_or_calculate_network()
+    connections = ConnectionsAccess.from_graph(graph)
+    rides = RidesGraph(graph, trips)
+    cache = PathCache(PATH_CACHE_DIRECTORY, key, memory_items=256)
+    landmarks = load_or_calculate_landmarks(graph, key)
+    travel_matrix = TravelMatrix.load(TRAVEL_MATRIX_FILE, key, graph)
+    if travel_matrix is not None:
+        print(f"Travel matrix of {len(travel_matrix.get_origins())} origins loaded from {TRAVEL_MATRIX_FILE}")
+
+    service = QueryService(connections, rides, arguments.transfer_minutes, cache, arguments.processes,
+                           landmarks=landmarks, travel_matrix=travel_matrix)
+    where = arguments.unix_socket or f"http://{arguments.host}:{arguments.port}"
+    print(f"Serving queries on {where}")
+    try:
+        asyncio.run(service.serve(arguments.host, arguments.port, arguments.unix_socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
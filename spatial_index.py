@@ -0,0 +1,134 @@
+import math
+
+
+EARTH_RADIUS_M = 6372800
+WALKING_SPEED_KMH = 4.5
+
+
+def walking_minutes(meters: float, speed_kmh: float = WALKING_SPEED_KMH) -> float:
+    return meters / 1000 / speed_kmh * 60
+
+
+def haversine_many(gps: tuple, latitudes, longitudes) -> list:
+    """
+    Distances in meters from one GPS coordinate (latitude, longitude)
+    to all the coordinates given as sequences of latitudes and longitudes.
+    The query point terms are calculated once for all of them.
+    """
+    (lat, lon) = gps
+    phi = math.radians(lat)
+    cos_phi = math.cos(phi)
+    lam = math.radians(lon)
+    (sin, cos, asin, sqrt, radians) = (math.sin, math.cos, math.asin, math.sqrt, math.radians)
+
+    distances = []
+    for (lat_2, lon_2) in zip(latitudes, longitudes):
+        phi_2 = radians(lat_2)
+        a = sin((phi_2 - phi) / 2) ** 2 + cos_phi * cos(phi_2) * sin((radians(lon_2) - lam) / 2) ** 2
+        distances.append(2 * EARTH_RADIUS_M * asin(sqrt(min(a, 1.0))))
+
+    return distances
+
+
+class SpatialIndex():
+    """
+    Uniform grid over the stop coordinates projected to meters (equirectangular
+    projection around the mean latitude, accurate enough on a city scale).
+    Stop IDs are the indexes into the latitudes and longitudes (e.g. of a ConnectionsGraph).
+    Each cell keeps the IDs of its stops, so nearest and radius queries only
+    measure the stops of the cells around the query point. Stops without GPS are left out.
+    """
+
+    def __init__(self, latitudes, longitudes, cell_m: float = 500.0):
+        self._latitudes = latitudes
+        self._longitudes = longitudes
+        self._cell_m = cell_m
+
+        ids = [index for index in range(len(latitudes)) if not math.isnan(latitudes[index])]
+        latitude_mean = sum(latitudes[index] for index in ids) / len(ids) if ids else 0.0
+        self._x_scale = math.radians(1) * EARTH_RADIUS_M * math.cos(math.radians(latitude_mean))  # Meters per degree
+        self._y_scale = math.radians(1) * EARTH_RADIUS_M
+
+        self._cells = {}  # (Cell x, Cell y): [Stop IDs]
+        for index in ids:
+            self._cells.setdefault(self._get_cell((latitudes[index], longitudes[index])), []).append(index)
+
+        cells = list(self._cells) or [(0, 0)]
+        self._bounds = (min(x for (x, _) in cells), min(y for (_, y) in cells),
+                        max(x for (x, _) in cells), max(y for (_, y) in cells))
+
+    def nearest(self, gps: tuple, k: int = 1) -> list:
+        """
+        The k stops closest to the GPS coordinate (latitude, longitude),
+        returns [(Stop ID, meters), ...] in ascending order of the distance.
+        Rings of cells around the query cell are searched until the k-th closest
+        candidate is closer than anything outside the searched rings.
+        Points outside the bounds of the cells with stops (e.g. swapped coordinates)
+        measure all the stops at once, the rings would be far from the stops.
+        """
+        if k < 1:
+            raise ValueError(f"Number of nearest stops must be at least 1, not {k}")
+
+        (cell_x, cell_y) = self._get_cell(gps)
+        (min_x, min_y, max_x, max_y) = self._bounds
+        if not (min_x <= cell_x <= max_x and min_y <= cell_y <= max_y):
+            return self._measure(gps, [stop_id for stop_ids in self._cells.values() for stop_id in stop_ids])[:k]
+
+        candidates = []
+        ring = 0
+        while True:
+            for cell in self._get_ring(cell_x, cell_y, ring):
+                candidates.extend(self._cells.get(cell, ()))
+
+            covers_all = cell_x - ring <= min_x and cell_y - ring <= min_y and cell_x + ring >= max_x and cell_y + ring >= max_y
+            if len(candidates) >= k or covers_all:
+                result = self._measure(gps, candidates)
+                # Stops within ring x cell size are all in the searched cells
+                if covers_all or result[k - 1][1] <= ring * self._cell_m * 0.99:
+                    return result[:k]
+            ring += 1
+
+    def within(self, gps: tuple, radius_m: float) -> list:
+        """
+        All stops not farther than radius_m meters from the GPS coordinate,
+        returns [(Stop ID, meters), ...] in ascending order of the distance.
+        """
+        (cell_x, cell_y) = self._get_cell(gps)
+        cell_radius = int(math.ceil(radius_m / self._cell_m * 1.01))
+
+        candidates = []
+        for x in range(cell_x - cell_radius, cell_x + cell_radius + 1):
+            for y in range(cell_y - cell_radius, cell_y + cell_radius + 1):
+                candidates.extend(self._cells.get((x, y), ()))
+
+        return [(stop_id, meters) for (stop_id, meters) in self._measure(gps, candidates) if meters <= radius_m]
+
+    def _get_cell(self, gps: tuple) -> tuple:
+        return (math.floor(gps[1] * self._x_scale / self._cell_m), math.floor(gps[0] * self._y_scale / self._cell_m))
+
+    def _get_ring(self, cell_x: int, cell_y: int, ring: int) -> list:
+        """
+        Cells on the border of the square with the ring distance around the cell,
+        only the ones within the bounds of the cells with stops, so the rings stay small.
+        """
+        if ring == 0:
+            return [(cell_x, cell_y)]
+
+        (min_x, min_y, max_x, max_y) = self._bounds
+        cells = []
+        x_range = range(max(cell_x - ring, min_x), min(cell_x + ring, max_x) + 1)
+        for y in (cell_y - ring, cell_y + ring):
+            if min_y <= y <= max_y:
+                cells.extend((x, y) for x in x_range)
+        y_range = range(max(cell_y - ring + 1, min_y), min(cell_y + ring - 1, max_y) + 1)
+        for x in (cell_x - ring, cell_x + ring):
+            if min_x <= x <= max_x:
+                cells.extend((x, y) for y in y_range)
+
+        return cells
+
+    def _measure(self, gps: tuple, candidates: list) -> list:
+        distances = haversine_many(gps, [self._latitudes[stop_id] for stop_id in candidates],
+                                   [self._longitudes[stop_id] for stop_id in candidates])
+
+        return sorted(zip(candidates, distances), key=lambda tup: tup[1])
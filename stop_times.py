@@ -0,0 +1,107 @@
+from array import array
+from dataclasses import dataclass, field
+from itertools import compress, repeat
+from operator import is_not, itemgetter
+
+
+@dataclass
+class StopTimes:
+    """
+    Columnar form of the GTFS stop_times.txt rows of the trips in the time period.
+    Rows of one trip are consecutive, row values are indexes into trip_ids and stop_ids.
+    The departure is in seconds from the service day start.
+    """
+    trip_ids: list = field(default_factory=list)  # GTFS trip_id
+    stop_ids: list = field(default_factory=list)  # GTFS stop_id
+    trips: array = field(default_factory=lambda: array("l"))
+    stops: array = field(default_factory=lambda: array("l"))
+    departures: array = field(default_factory=lambda: array("l"))
+    traveled: array = field(default_factory=lambda: array("d"))
+    scanned_rows: int = 0  # All rows of the file, also of the trips out of the time period
+
+    def __len__(self):
+        return len(self.trips)
+
+
+def parse_time(value: str) -> int:
+    """
+    Parse GTFS HH:MM:SS time (hours can be over 24) to seconds.
+    """
+    (h, m, s) = value.split(":")
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+def parse_times(values: list) -> list:
+    """
+    Parse a column of GTFS HH:MM:SS times to seconds at once.
+    The colons are dropped from the joined column, so each time is read as one HHMMSS number.
+    """
+    numbers = map(int, ",".join(values).replace(":", "").split(","))
+    return [(n // 10000) * 3600 + (n // 100 % 100) * 60 + n % 100 for n in numbers]
+
+
+def read_stop_times(input_stop_times: str, start_hour: int = 0, stop_hour: int = 48,
+                    chunk_bytes: int = 1 << 16) -> StopTimes:
+    """
+    Stream stop_times.txt in chunks of about chunk_bytes into columnar arrays.
+    Only trips departing from their first stop between start_hour and stop_hour
+    (both inclusive) are kept, the rest is dropped during the scan.
+    Small chunks keep the number of live row objects (and the GC work) low.
+    """
+    result = StopTimes()
+    trip_indexes = {}
+    stop_indexes = {}
+
+    with open(input_stop_times, encoding="utf8") as f:
+        columns = f.readline().strip().split(",")
+        if len(columns) != 9 or columns[0] != "trip_id" or columns[-1] != "shape_dist_traveled":
+            raise Exception(f"Wrong file content: {columns}")
+
+        last_trip_id = None
+
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+
+            # Only the columns before the stop_headsign and the last one are used,
+            # so a plain split is safe even for quoted headsigns with commas
+            rows = [line.rstrip("\r\n").split(",") for line in lines if line.strip()]
+            if not rows:
+                continue
+            result.scanned_rows += len(rows)
+            trip_column = list(map(itemgetter(0), rows))
+            departure_column = list(map(itemgetter(2), rows))
+            stop_column = list(map(itemgetter(3), rows))
+            traveled_column = list(map(itemgetter(-1), rows))
+
+            # Decide once per trip by its first departure, the trip continuing
+            # from the previous chunk keeps its decision
+            first_departures = dict(zip(reversed(trip_column), reversed(departure_column)))
+            for trip_id in dict.fromkeys(trip_column):
+                if trip_id != last_trip_id and start_hour <= int(first_departures[trip_id].split(":", 1)[0]) <= stop_hour:
+                    trip_indexes.setdefault(trip_id, len(trip_indexes))
+            last_trip_id = trip_column[-1]
+
+            row_trips = list(map(trip_indexes.get, trip_column))
+            if row_trips.count(None) > 0:
+                keep = list(map(is_not, row_trips, repeat(None)))
+                if not any(keep):
+                    continue
+                row_trips = list(compress(row_trips, keep))
+                departure_column = list(compress(departure_column, keep))
+                stop_column = list(compress(stop_column, keep))
+                traveled_column = list(compress(traveled_column, keep))
+
+            for stop_id in dict.fromkeys(stop_column):
+                stop_indexes.setdefault(stop_id, len(stop_indexes))
+
+            result.trips.extend(row_trips)
+            result.stops.extend(map(stop_indexes.__getitem__, stop_column))
+            result.departures.extend(parse_times(departure_column))
+            result.traveled.extend(map(float, traveled_column))
+
+    result.trip_ids = list(trip_indexes)
+    result.stop_ids = list(stop_indexes)
+
+    return result
@@ -0,0 +1,134 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import math
+
+from stop_times import StopTimes
+
+
+class Timetable():
+    """
+    Timetable connections for the Connection Scan Algorithm (CSA).
+    One connection is a vehicle ride between two consecutive stops of a trip
+    with its real departure and arrival times in seconds. Connections are
+    sorted by departure and arrival, stops are the unique stop names as in the graph.
+    Footpaths of each stop are (stop, seconds) to the stops in walking distance.
+    """
+
+    def __init__(self, names: list, departure_stops: array, arrival_stops: array,
+                 departures: array, arrivals: array, trips: array, trip_count: int, footpaths: list = None):
+        self.names = names
+        self.departure_stops = departure_stops
+        self.arrival_stops = arrival_stops
+        self.departures = departures
+        self.arrivals = arrivals
+        self.trips = trips
+        self.trip_count = trip_count
+        self.footpaths = footpaths if footpaths is not None else [[] for _ in names]
+        self._ids = {name: index for (index, name) in enumerate(names)}
+
+    @classmethod
+    def from_stop_times(cls, stop_times: StopTimes, stop_names: dict, footpaths: dict = None):
+        """
+        Build the timetable from the columnar stop times, stop_names maps GTFS stop_id to stop name.
+        The arrival at a stop is its departure time, the same as for the trip distances.
+        Footpaths map (stop name, stop name) to walking minutes.
+        """
+        names = list(dict.fromkeys(stop_names[stop_id] for stop_id in stop_times.stop_ids))
+        ids = {name: index for (index, name) in enumerate(names)}
+        stops = [ids[stop_names[stop_id]] for stop_id in stop_times.stop_ids]
+
+        rows = [row for row in range(1, len(stop_times)) if stop_times.trips[row] == stop_times.trips[row - 1]]
+        # Ties of the departure by arrival, so the zero minutes rides of a time are together
+        # and scanned before the other rides departing at the time
+        rows.sort(key=lambda row: (stop_times.departures[row - 1], stop_times.departures[row]))
+
+        departure_stops = array("l", (stops[stop_times.stops[row - 1]] for row in rows))
+        arrival_stops = array("l", (stops[stop_times.stops[row]] for row in rows))
+        departures = array("l", (stop_times.departures[row - 1] for row in rows))
+        arrivals = array("l", (stop_times.departures[row] for row in rows))
+        trips = array("l", (stop_times.trips[row] for row in rows))
+
+        stop_footpaths = [[] for _ in names]
+        for ((name_from, name_to), minutes) in (footpaths or {}).items():
+            if name_from in ids and name_to in ids:
+                stop_footpaths[ids[name_from]].append((ids[name_to], round(minutes * 60)))
+
+        return cls(names, departure_stops, arrival_stops, departures, arrivals, trips, len(stop_times.trip_ids), stop_footpaths)
+
+    def get_connection_count(self) -> int:
+        return len(self.departures)
+
+    def earliest_arrival(self, stop: str, departure_time: int, max_minutes: float = math.inf,
+                         transfer_seconds: int = 0) -> dict:
+        """
+        Earliest arrival (in seconds) at every reachable stop, departing from the stop
+        at the departure time (in seconds). Only connections departing in max_minutes
+        are scanned. Changing the trip at a stop takes transfer_seconds.
+        After arriving at a stop its footpaths are walked (one footpath at a time,
+        walking replaces the transfer time). Zero minutes rides at the same time
+        are scanned until they do not improve, whatever their order is.
+        Returns dictionary stop name: arrival seconds.
+        """
+        origin = self._ids[stop]
+        arrival_times = [math.inf] * len(self.names)
+        ready_times = [math.inf] * len(self.names)  # Time to board a new trip at the stop
+        arrival_times[origin] = departure_time
+        ready_times[origin] = departure_time
+        trip_reached = bytearray(self.trip_count)
+        footpaths = self.footpaths
+
+        def walk(stop: int, time: int):
+            for (target, seconds) in footpaths[stop]:
+                if time + seconds < arrival_times[target]:
+                    arrival_times[target] = time + seconds
+                    ready_times[target] = time + seconds
+
+        def scan_zero_rides(group: list):
+            # Zero minutes rides at the same time can feed each other in any order of the file,
+            # so they are scanned again until no trip or arrival is improved
+            changed = True
+            while changed:
+                changed = False
+                for (departure_stop, arrival_stop, time, trip) in group:
+                    if not trip_reached[trip] and ready_times[departure_stop] <= time:
+                        trip_reached[trip] = 1
+                        changed = True
+                    if trip_reached[trip] and time < arrival_times[arrival_stop]:
+                        arrival_times[arrival_stop] = time
+                        ready_times[arrival_stop] = time + transfer_seconds
+                        walk(arrival_stop, time)
+                        changed = True
+
+        walk(origin, departure_time)
+
+        start = bisect_left(self.departures, departure_time)
+        if max_minutes == math.inf:
+            end = len(self.departures)
+        else:
+            end = bisect_right(self.departures, departure_time + max_minutes * 60)
+
+        connections = zip(self.departure_stops[start:end], self.arrival_stops[start:end],
+                          self.departures[start:end], self.arrivals[start:end], self.trips[start:end])
+        zero_rides = []  # Zero minutes rides of the current time
+        for (departure_stop, arrival_stop, departure, arrival, trip) in connections:
+            if departure == arrival:
+                if zero_rides and zero_rides[0][2] != departure:
+                    scan_zero_rides(zero_rides)
+                    zero_rides = []
+                zero_rides.append((departure_stop, arrival_stop, departure, trip))
+                continue
+            if zero_rides:
+                scan_zero_rides(zero_rides)
+                zero_rides = []
+
+            if trip_reached[trip] or ready_times[departure_stop] <= departure:
+                trip_reached[trip] = 1
+                if arrival < arrival_times[arrival_stop]:
+                    arrival_times[arrival_stop] = arrival
+                    ready_times[arrival_stop] = arrival + transfer_seconds
+                    if footpaths[arrival_stop]:
+                        walk(arrival_stop, arrival)
+        if zero_rides:
+            scan_zero_rides(zero_rides)
+
+        return {self.names[index]: arrival for (index, arrival) in enumerate(arrival_times) if arrival != math.inf}
@@ -1,60 +1,77 @@
 
 
-def update_path_with_transfer_count(all_paths, trips):
+def update_path_with_transfer_count(all_paths, trips, footpaths=None):
     """
     Takes all paths list with dictionary and updates them with transfers needed from trips 
+    Footpaths is a set of walked (stop, next stop) pairs, see get_transfer_count.
     """
+    trip_index = build_trip_index(trips)
     for paths in all_paths:
         for path in paths.values():
-            path["transfers"] = get_transfer_count(path["path"], trips)
+            path["transfers"] = get_transfer_count(path["path"], trips, trip_index, footpaths)
 
 
-def get_transfer_count(path, connections):
+def build_trip_index(trips):
+    """
+    Index of trips by their stop pairs.
+    Returns dictionary (stop, next stop): set of (trip index, position of the stop in trip).
+    """
+    trip_index = {}
+    for (trip_number, trip) in enumerate(trips):
+        for position in range(len(trip) - 1):
+            trip_index.setdefault((trip[position], trip[position + 1]), set()).add((trip_number, position))
+
+    return trip_index
+
+
+def get_transfer_count(path, connections, trip_index=None, footpaths=None):
+    """
+    Number of changes between trips along the path.
+    Segments in footpaths (set of (stop, next stop)) are walked, walking is not a trip,
+    so walking from one trip to another is one transfer.
+    """
     index = 0
-    transfer_count = 0
+    trip_count = 0
 
     if len(path) <= 2:
         return 0
 
-    while True:
-        index += find_most_direct_stop_count(path, index, connections)
-        if path[index] == path[-1]:
-            break
-        else:
-            transfer_count += 1
-
-    return transfer_count
+    if trip_index is None:
+        trip_index = build_trip_index(connections)
 
+    while index < len(path) - 1:
+        if footpaths and (path[index], path[index + 1]) in footpaths:
+            index += 1
+            continue
 
-def find_most_direct_stop_count(path, path_index, connections):
-    direct_length_max = 0
-    for connection in connections:
-        connection_index = 0
-        while connection_index < len(connection):
-            if connection[connection_index] == path[path_index]:
-                direct_match = 1
-                while True:
-                    if connection_index + direct_match >= len(connection) or path_index + direct_match >= len(path):
-                        break
+        index += find_most_direct_stop_count(path, index, connections, trip_index)
+        trip_count += 1
 
-                    if connection[connection_index + direct_match] == path[path_index + direct_match]:
-                        direct_match += 1
-                    else:
-                        break
+    return max(trip_count - 1, 0)
 
-                direct_length = direct_match - 1
-                if direct_length > direct_length_max:
-                    direct_length_max = direct_length
 
-                break
+def find_most_direct_stop_count(path, path_index, connections, trip_index=None):
+    """
+    Number of stops along the path, that can be traveled by one trip from the path index.
+    Starts with all trips riding the first path segment and keeps only those
+    continuing with each next segment, until none is left or the target is reached.
+    """
+    if trip_index is None:
+        trip_index = build_trip_index(connections)
 
-            else:
-                connection_index += 1
+    if path_index + 1 >= len(path):
+        return 1  # This should never happen, but...
 
-        if path_index + direct_length_max == len(path) - 1:
-            break  # We are in the target stop
+    riding = trip_index.get((path[path_index], path[path_index + 1]))
+    if not riding:
+        return 1  # This should never happen, but...
 
-    if direct_length_max == 0:
-        direct_length_max = 1  # This should never happen, but...
+    direct_length_max = 1
+    while path_index + direct_length_max < len(path) - 1:
+        segment = trip_index.get((path[path_index + direct_length_max], path[path_index + direct_length_max + 1]), ())
+        riding = {(trip, position) for (trip, position) in riding if (trip, position + direct_length_max) in segment}
+        if not riding:
+            break
+        direct_length_max += 1
 
     return direct_length_max
@@ -0,0 +1,165 @@
+import argparse
+from array import array
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+
+from connections_graph import ConnectionsGraph, RidesGraph
+from meeting_point import score_matrix, top_k
+from network import TRANSFER_MINUTES, TRAVEL_MATRIX_FILE, load_or_calculate_network
+from path_calculations import ConnectionsAccess, TravelTimes, create_calculation
+
+
+# Binary travel matrix layout (little endian): header, origin stop IDs (int32),
+# then for each origin a row of minutes x 10 and a row of transfers for all stops (uint16)
+MATRIX_MAGIC = b"PIDMTX\0\0"
+_HEADER = struct.Struct("<8s32sIId")
+UNREACHABLE = 0xFFFF
+MINUTES_SCALE = 10  # Minutes are stored in tenths, the precision of the path results
+
+# Decoded minutes for every stored value, so a row is decoded by one map
+_MINUTES = [value / MINUTES_SCALE for value in range(UNREACHABLE)] + [math.inf]
+
+# Shared read-only state of the row worker processes, inherited on fork (copy-on-write)
+_matrix_state = None
+
+
+class TravelMatrix():
+    """
+    Precomputed minutes and transfers from the origin stops (hubs or all stops) to all stops,
+    memory-mapped from the matrix file. Meeting points of origins in the matrix
+    are scored from the gathered rows without any graph search.
+    """
+
+    def __init__(self, graph: ConnectionsGraph, origin_ids: memoryview, rows: memoryview, transfer_minutes: float):
+        self._graph = graph
+        self._rows = rows  # uint16, 2 rows (minutes, transfers) of stop count values for each origin
+        self.transfer_minutes = transfer_minutes
+        self._origin_rows = {graph.names[origin_id]: row for (row, origin_id) in enumerate(origin_ids)}
+
+    @classmethod
+    def load(cls, matrix_file: str, key: bytes, graph: ConnectionsGraph):
+        """
+        Map the matrix file of the network version key, None if it is missing or stale.
+        """
+        try:
+            with open(matrix_file, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None  # Missing or empty file
+
+        if len(data) < _HEADER.size:
+            return None
+        (magic, file_key, origin_count, stop_count, transfer_minutes) = _HEADER.unpack_from(data)
+        if magic != MATRIX_MAGIC or file_key != key or stop_count != graph.get_stop_count():
+            return None
+
+        view = memoryview(data)
+        position = _HEADER.size
+        origin_ids = view[position:position + origin_count * 4].cast("i")
+        position += origin_count * 4
+        rows = view[position:position + origin_count * 2 * stop_count * 2].cast("H")
+
+        return cls(graph, origin_ids, rows, transfer_minutes)
+
+    def get_origins(self) -> list:
+        return list(self._origin_rows)
+
+    def has_origin(self, stop: str) -> bool:
+        return stop in self._origin_rows
+
+    def get_travel_times(self, origins: list) -> TravelTimes:
+        """
+        Minutes and transfers matrices of the origins, gathered from the stored rows.
+        There are no paths in the results.
+        """
+        stop_count = self._graph.get_stop_count()
+        travel_times = TravelTimes(origins=list(origins), stops=self._graph.names, minutes=[], transfers=[], results=[])
+        for origin in origins:
+            start = self._origin_rows[origin] * 2 * stop_count
+            travel_times.minutes.append(array("d", map(_MINUTES.__getitem__, self._rows[start:start + stop_count])))
+            travel_times.transfers.append(array("l", self._rows[start + stop_count:start + 2 * stop_count]))
+            travel_times.results.append([])
+
+        return travel_times
+
+    def find_meeting_points(self, origins: list, k: int = 10, scorer="fair") -> list:
+        """
+        The k best meeting stops of the origins, returns [(Name, Score), ...].
+        """
+        travel_times = self.get_travel_times(origins)
+        scores = score_matrix(travel_times.minutes, travel_times.transfers, self.transfer_minutes, scorer)
+
+        return [(travel_times.stops[index], scores[index]) for index in top_k(scores, k)]
+
+
+def build_travel_matrix(matrix_file: str, key: bytes, connections: ConnectionsAccess, rides: RidesGraph = None,
+                        transfer_minutes: float = 0.0, origins: list = None, processes: int = None):
+    """
+    Calculate the rows of the origins (all stops without origins) in parallel worker processes
+    and write them to the matrix file of the network version key as they are done.
+    Without rides the transfers are zero.
+    """
+    global _matrix_state
+    graph = connections.get_graph()
+    if origins is None:
+        origins = connections.get_stops()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    _matrix_state = (connections, rides, transfer_minutes)
+    temporary_file = matrix_file + ".tmp"
+    try:
+        with open(temporary_file, "wb") as f:
+            f.write(_HEADER.pack(MATRIX_MAGIC, key, len(origins), graph.get_stop_count(), transfer_minutes))
+            f.write(array("i", (graph.get_id(origin) for origin in origins)).tobytes())
+
+            if processes > 1 and "fork" in multiprocessing.get_all_start_methods():
+                with multiprocessing.get_context("fork").Pool(processes) as pool:
+                    for row in pool.imap(_calculate_row, origins, chunksize=8):
+                        f.write(row)
+            else:
+                for origin in origins:
+                    f.write(_calculate_row(origin))
+    finally:
+        _matrix_state = None
+    os.replace(temporary_file, matrix_file)
+
+
+def _calculate_row(start_stop: str) -> bytes:
+    (connections, rides, transfer_minutes) = _matrix_state
+    graph = connections.get_graph()
+    calculation = create_calculation(connections, start_stop, rides, transfer_minutes)
+
+    minutes = array("H", [UNREACHABLE]) * graph.get_stop_count()
+    transfers = array("H", [UNREACHABLE]) * graph.get_stop_count()
+    for result in calculation.get_results():
+        stop_id = graph.get_id(result[0])
+        minutes[stop_id] = min(round(result[1] * MINUTES_SCALE), UNREACHABLE - 1)
+        transfers[stop_id] = min(result[2], UNREACHABLE - 1) if rides is not None else 0
+
+    return minutes.tobytes() + transfers.tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the travel matrix for meeting point lookups")
+    parser.add_argument("--hubs", type=int, help="Only the stops with the most connections as origins")
+    parser.add_argument("--processes", type=int, help="Number of worker processes")
+    parser.add_argument("--transfer-minutes", type=float, default=TRANSFER_MINUTES)
+    arguments = parser.parse_args()
+
+    (graph, trips, key) = load_or_calculate_network()
+    connections = ConnectionsAccess.from_graph(graph)
+    origins = connections.get_stops()
+    if arguments.hubs:
+        origins = sorted(origins, key=lambda stop: -len(graph.get_connections(graph.get_id(stop))))[:arguments.hubs]
+
+    print(f"Calculating travel matrix of {len(origins)} origins to {TRAVEL_MATRIX_FILE}")
+    build_travel_matrix(TRAVEL_MATRIX_FILE, key, connections, RidesGraph(graph, trips), arguments.transfer_minutes,
+                        origins, arguments.processes)
+
+
+if __name__ == "__main__":
+    main()